@@ -26,14 +26,29 @@ LPORT = 34888
 # metadata paths
 FOLDERS_CACHE_PATH = '~/.gdrive_sync/folders/'
 DATABASE_PATH = '~/.gdrive_sync/md.db'
+DISCOVERY_CACHE_PATH = '~/.gdrive_sync/drive.v3.json' # used if the client library doesn't ship the document
 
 # local google drive copy path
 DRIVE_CACHE_PATH = "~/gdrive/"
 
 # operation specific variables
 PAGE_SIZE = 50
-FOLDER_FIELDS = 'files(*)'
-FILE_FIELDS = 'files(*)'
+BATCH_MAX_SIZE = 100 # calls per Drive batch request, 100 is the API limit
+# field projections for Drive API calls. nothing asks for '*', which drags in the permissions,
+# capabilities and owners blobs. OBJECT_FIELDS is what gets stored in the db for every object,
+# extend it (or one of the operation specific sets) here when code needs another property.
+OBJECT_FIELDS = "id, name, mimeType, parents, version, md5Checksum, size, modifiedTime, trashed, ownedByMe"
+LIST_FIELDS = OBJECT_FIELDS # folder and file listings
+CHANGE_FIELDS = OBJECT_FIELDS # enriching changed objects
+PATH_FIELDS = "id, name, mimeType, parents, ownedByMe" # walking parents to build a local path
+UPLOAD_FIELDS = OBJECT_FIELDS # verifying created and uploaded objects (needs md5Checksum)
+SCAN_FIELDS = "id, name, mimeType, version, md5Checksum, parents, ownedByMe" # startup comparison with the db
+# changes.list embeds the changed file, so no follow-up get is needed per change
+CHANGES_LIST_FIELDS = "nextPageToken, newStartPageToken, changes(fileId, removed, time, file(" + CHANGE_FIELDS + "))"
+CHANGES_PAGE_SIZE = 1000
+BOOTSTRAP_FIELDS = OBJECT_FIELDS # first sync snapshot listing, stored as-is in the db
+FOLDER_FIELDS = 'files(' + LIST_FIELDS + ')'
+FILE_FIELDS = 'files(' + LIST_FIELDS + ')'
 EXPORT_NATIVE_DOCS = False
 MEDIA_EXPORT_MATRIX = {
             "application/vnd.google-apps.document": { 
@@ -45,8 +60,95 @@ MEDIA_EXPORT_MATRIX = {
                     "extension": ".xslx"
             }
 }
+# first sync from one flat listing of the whole drive instead of a listing per folder
+BOOTSTRAP_SNAPSHOT = True
+BOOTSTRAP_PAGE_SIZE = 1000 # largest page files.list allows
+BOOTSTRAP_INSERT_SIZE = 10000 # objects per db transaction while loading the snapshot
+# client-side quota governor. every Drive call takes a permit from the token bucket for its
+# kind (metadata or media) before it goes out, shared by all threads. rates are permits per
+# second, burst is how many can go out back to back after an idle spell
+QUOTA_GOVERNOR = True
+QUOTA_METADATA_RATE = 15
+QUOTA_METADATA_BURST = 30
+QUOTA_MEDIA_RATE = 8
+QUOTA_MEDIA_BURST = 16
+# socket timeouts in seconds for each class of Drive request. connect bounds the TCP and TLS
+# handshake, read bounds every wait for data on an open connection, so a long transfer that
+# keeps moving isn't cut off but a stalled one doesn't hold its worker forever
+REQUEST_TIMEOUTS = {
+            "metadata": {"connect": 10, "read": 60},
+            "media": {"connect": 10, "read": 120},
+            "upload": {"connect": 10, "read": 300}
+}
+# hedged metadata reads. once HEDGE_MIN_SAMPLES metadata reads have been timed, a read still
+# unanswered after the HEDGE_PERCENTILE latency of the last HEDGE_SAMPLE_WINDOW reads (but at
+# least HEDGE_MIN_DELAY seconds) is sent a second time and the first answer wins. at most
+# HEDGE_WORKERS reads are hedgeable at once, the rest go out unhedged, and a hedge is skipped
+# when HEDGE_MAX_OUTSTANDING hedges are already in flight
+HEDGE_METADATA_READS = False
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_DELAY = 0.5
+HEDGE_MIN_SAMPLES = 50
+HEDGE_SAMPLE_WINDOW = 500
+HEDGE_WORKERS = 16
+HEDGE_MAX_OUTSTANDING = 4
+# failed Drive operations are queued again after an exponential backoff with jitter, or after
+# the Retry-After the API asked for if that's longer. tasks that run out of attempts or fail
+# with an error that won't go away are recorded in the dead_letters table
+RETRY_MAX_ATTEMPTS = 6
+RETRY_BASE_DELAY = 2 # seconds before the first retry
+RETRY_MAX_DELAY = 300
+RETRY_RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'sharingRateLimitExceeded']
+# statuses that mean Drive won't take a stored changes token any more, so startup falls back to
+# a full scan. anything else is either retried or fails the catch up
+CHANGES_TOKEN_REJECTED_STATUS = [400, 404, 410]
 UPLOAD_RETRIES_MAX = 3
+DOWNLOAD_RETRIES_MAX = 3
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # bytes held in memory per in-flight download
+DOWNLOAD_TEMP_SUFFIX = '.gdsync.part'
+# files at least this big are fetched as parallel HTTP range segments
+MULTIPART_DOWNLOAD_THRESHOLD = 256 * 1024 * 1024
+MULTIPART_SEGMENT_SIZE = 64 * 1024 * 1024
+MULTIPART_DOWNLOAD_THREADS = 4 # connections per file
 POLLING_INTERVAL = 5 #seconds
+# polling backs off towards POLLING_INTERVAL_MAX while the drive is idle and drops back to
+# POLLING_INTERVAL as soon as a poll finds changes. delays are jittered by +/- POLLING_JITTER
+POLLING_INTERVAL_MAX = 60
+POLLING_BACKOFF = 2.0
+POLLING_JITTER = 0.2
+# push notifications through a changes.watch channel. Google posts to NOTIFY_ADDRESS, which
+# has to be a public https url that forwards to the receiver listening on NOTIFY_LISTEN_HOST/PORT.
+# polling carries on as a fallback, backing off up to NOTIFY_POLLING_INTERVAL_MAX. if NOTIFY_ADDRESS
+# isn't an https url, notifications are switched off at startup and only polling runs
+CHANGE_NOTIFICATIONS = False
+NOTIFY_ADDRESS = ''
+NOTIFY_LISTEN_HOST = '127.0.0.1'
+NOTIFY_LISTEN_PORT = 8765
+NOTIFY_CHANNEL_TTL = 3600 # seconds a channel is asked to live before it's renewed
+NOTIFY_RENEW_MARGIN = 300 # renew this many seconds before the channel expires
+NOTIFY_POLLING_INTERVAL_MAX = 300
+# transfers are split into lanes by size, each with its own number of workers. an item goes
+# into the first lane whose max_size (bytes) it fits under, None means no limit. "workers" is
+# the most transfers a lane runs at once, how many it actually runs is adjusted at runtime
+TRANSFER_LANES = [
+            {"name": "small", "max_size": 16 * 1024 * 1024, "workers": 8},
+            {"name": "bulk", "max_size": None, "workers": 4}
+]
+TRANSFER_STATS_INTERVAL = 30 #seconds between transfer progress log lines
+# AIMD control of transfer concurrency per lane. every CONCURRENCY_INTERVAL a lane that kept all
+# of its slots busy gets one more if throughput held up and latency stayed within
+# CONCURRENCY_LATENCY_TOLERANCE of the best seen. 429 and 5xx responses and timeouts cut it by
+# CONCURRENCY_DECREASE, at most once per interval, in the lane whose task saw them. a lane never
+# drops below CONCURRENCY_MIN
+CONCURRENCY_MIN = 1
+CONCURRENCY_INTERVAL = 5 #seconds
+CONCURRENCY_DECREASE = 0.5
+CONCURRENCY_LATENCY_TOLERANCE = 0.25
+# uploads of locally changed files are held until the file has stopped changing: no event for
+# LOCAL_DEBOUNCE_QUIET seconds and the same size and mtime as at the last event. a file that
+# keeps changing is uploaded anyway after LOCAL_DEBOUNCE_MAX_DELAY seconds. 0 turns it off
+LOCAL_DEBOUNCE_QUIET = 2
+LOCAL_DEBOUNCE_MAX_DELAY = 30
 
 # global variables that store dynamic values
 ROOT_FOLDER_ID = ""
@@ -60,6 +162,12 @@ TYPE_GOOGLE_FOLDER = 'application/vnd.google-apps.folder'
 LOCAL_QUEUE = None
 REMOTE_QUEUE = None
 OBSERVER = None
+LOCAL_DEBOUNCER = None
+TRANSFER_SCHEDULER = None
+PATH_RESOLVER = None
+NAMESPACE = None
+PROCESS_START = None
+FIRST_SYNC_ACTION = None # seconds from process start to the first sync action
 # ignore changes to these files (temporarily) while changes are being processed
 # this is to avoid processing inotify changes for files we just downloaded and uploaded
 LQUEUE_IGNORE = list()
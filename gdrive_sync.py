@@ -1,6 +1,9 @@
 #!/usr/bin/env python3.8
 
 from __future__ import print_function
+# taken before the heavy imports so startup time can be measured
+import time
+PROCESS_START = time.monotonic()
 #from shelve import DbfilenameShelf
 from time import sleep
 from typing import List
@@ -10,21 +13,27 @@ import os.path
 import queue
 
 # google and http imports
-from google.auth.transport.requests import Request
+# the oauth consent flow is only imported by login_to_drive when it's needed
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient import discovery
 
 # application imports
 from libdata.data_types import *
 from libdata.sqlite_store import *
 from libdata import sqlite_store
+from libdata import namespace
 from config import config as cfg
 from libgdrive.gDrive import *
 from lib.mods import *
 from lib.filewatcher import *
+from lib import transfers
+from lib import pool
+from lib import notifications
+from lib import retry
+from libgdrive import transport
+from libgdrive import quota
+from libgdrive import batch
+from libgdrive import planner
 
 
 # identify database entries of files not matching what's on disk.  delete the db entries.
@@ -119,34 +128,36 @@ def _runner():
     except Exception as err:
         logging.error("Google Drive watcher stopped. %s" % str(err))
 
-def _worker(lock=threading.Lock()):
+def _worker(lane:str):
 
-    # needs it's onw service object for multithreading
+    # needs it's own service object for multithreading, reused for every task of this thread
     try:
-        if cfg.USE_KEYRING == True:
-            kr = Keyring()
-            tokenStr = kr.get_data("gdrive", "token")
-            if tokenStr is not None and tokenStr != "":
-                tokenStr = json.loads(tokenStr)
-            credentials = Credentials.from_authorized_user_info(tokenStr, cfg.TARGET_SCOPES)
-        else:
-            credentials = Credentials.from_authorized_user_file(cfg.TOKEN_CACHE, cfg.TARGET_SCOPES)
-        authorized_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
-        service = discovery.build('drive', 'v3', requestBuilder=build_request, http=authorized_http)
+        service = pool.get_service()
         while True:
+            change = cfg.REMOTE_QUEUE.get(lane)
             try:
-                with lock:
-                    change = cfg.REMOTE_QUEUE.get()
-                    if change.mimeType == cfg.TYPE_GOOGLE_FOLDER:
-                        handle_changed_folder(service, change)
-                    elif change.mimeType == cfg.TYPE_GOOGLE_APPS:
-                        pass
-                    else:
-                        handle_changed_file(service, change)        
+                if change.mimeType == cfg.TYPE_GOOGLE_FOLDER:
+                    handle_changed_folder(service, change)
+                elif change.mimeType == cfg.TYPE_GOOGLE_APPS:
+                    pass
+                else:
+                    handle_changed_file(service, change)        
+                # the journal id can't be raised by a change attached after this point
+                cfg.REMOTE_QUEUE.detach()
+                if getattr(change, 'journalId', None) is not None:
+                    pool.get_database().delete_journal_entries(change.id, change.journalId)
+                planner.finish_change(change, pool.get_database(), True)
             except Exception as err:
-                logging.error("Error handling queue task. %s" % str(err))
+                # the journal entry stays until the change is applied or given up on
+                db = pool.get_database()
+                if not retry.retry_or_dead_letter(change, err, cfg.REMOTE_QUEUE, db, 'remote', \
+                                                    change.id, change.properties):
+                    cfg.REMOTE_QUEUE.detach()
+                    if getattr(change, 'journalId', None) is not None:
+                        db.delete_journal_entries(change.id, change.journalId)
+                    planner.finish_change(change, db, False)
             finally:
-                cfg.REMOTE_QUEUE.task_done()
+                cfg.REMOTE_QUEUE.task_done(lane)
     except Exception as err:
         logging.error("Error initializing remote queue worker. %s" % str(err))
 
@@ -182,6 +193,8 @@ def main():
         rootLogger.addHandler(consoleHandler)
 
         logging.info("Starting Google Drive sync")
+        cfg.PROCESS_START = PROCESS_START
+        logging.debug("modules loaded in %.3f seconds." % (time.monotonic() - PROCESS_START))
 
     except Exception as err:
         print(str(err))
@@ -208,9 +221,10 @@ def main():
         cfg.DATABASE.create_db(dbPath=cfg.DATABASE_PATH)
 
 
-    # max threads
+    # max threads. only sizes local hashing; how many transfers run at once is set per lane by
+    # TRANSFER_LANES and the concurrency controllers in lib.transfers
     #global MAX_THREADS
-    cfg.MAX_THREADS = os.cpu_count() - 1
+    cfg.MAX_THREADS = max(1, os.cpu_count() - 1)
     logging.info("Set up parallelism to %d threads", cfg.MAX_THREADS)
     
     """
@@ -228,7 +242,7 @@ def main():
     cfg.CREDENTIALS = creds
 
     # build the drive API service
-    service = build('drive', 'v3', credentials=creds)
+    service = pool.get_service()
     
     #populate root folder objects so that we can map the parents and children
     logging.debug("Fetching the root folder from Google drive.")    
@@ -240,21 +254,32 @@ def main():
     cfg.ROOT_FOLDER_OBJECT.localPath = cfg.DRIVE_CACHE_PATH + rootFolder.name
 
     cfg.DATABASE.open(dbPath=cfg.DATABASE_PATH)
+    cfg.NAMESPACE = namespace.NamespaceIndex()
+    cfg.NAMESPACE.load(cfg.DATABASE)
     rootFolder.localPath = os.path.join(cfg.DRIVE_CACHE_PATH, rootFolder.name)
     cfg.DATABASE.insert_gObject(folder=rootFolder) # won't insert a dupe
+    cfg.PATH_RESOLVER = namespace.PathResolver(cfg.NAMESPACE)
 
 
-    # initialize queueing
-    cfg.LOCAL_QUEUE = queue.Queue(maxsize=0)
-    cfg.REMOTE_QUEUE = queue.Queue(maxsize=0)
+    # initialize queueing. each queue is split into lanes by transfer size
+    # and keeps one pending change per file
+    cfg.LOCAL_QUEUE = transfers.LaneQueue(sizer=transfers.local_item_size, name="local", \
+                                            keyer=transfers.local_item_keys, coalescer=transfers.local_item_key)
+    cfg.REMOTE_QUEUE = transfers.LaneQueue(sizer=transfers.remote_item_size, name="remote", \
+                                            keyer=transfers.remote_item_keys, coalescer=transfers.remote_item_key, \
+                                            merger=transfers.merge_remote_items)
 
     # if this is the first run, skip the merge routine (local path is empty)
     if len(os.listdir(cfg.DRIVE_CACHE_PATH)) == 0:
+        log_first_sync_action("full download")
         logging.info("Local cache folder is empty.  Skipping merge routines and downloading everything.")
-        folders = read_folder_cache_from_db()
-        if len(folders) == 0:
-            write_folder_cache(service)
-        do_full_download(service, cfg.ROOT_FOLDER_OBJECT, cfg.DRIVE_CACHE_PATH)
+        if cfg.BOOTSTRAP_SNAPSHOT:
+            do_bootstrap_download(service, cfg.DRIVE_CACHE_PATH)
+        else:
+            folders = read_folder_cache_from_db()
+            if len(folders) == 0:
+                write_folder_cache(service)
+            do_full_download(service, cfg.ROOT_FOLDER_OBJECT, cfg.DRIVE_CACHE_PATH)
 
 
     # **************************************************************
@@ -281,6 +306,7 @@ def main():
     ************************************************************************************
 
     """
+    log_first_sync_action("local reconcile")
     logging.info("looking for files changed since the last startup. this might take a bit of time.")
     # make sure local database is reconciled with what's on disk
     reconcile_local_files_with_db2()
@@ -290,28 +316,23 @@ def main():
     # this is a full scan which should only be run upon the initial start up. 
     # once the program is running, it will subscribe to change notifications  
     
+    # a stored changes token means we can catch up from where the last run stopped, or from
+    # before the bootstrap snapshot was listed. the token for a full scan is taken before the
+    # scan so nothing that changes during it is missed
     google_drive_changes = []
-    google_drive_changes = get_gdrive_changes(service)
+    storedToken = cfg.DATABASE.fetch_sync_state('changes_token')
+    caughtUp = False
+    if storedToken is not None:
+        replay_change_journal(service)
+        caughtUp = catch_up_drive_changes(service, storedToken)
+    if not caughtUp:
+        cfg.CHANGES_TOKEN = get_drive_changes_token(service)
+        google_drive_changes = get_gdrive_changes(service)
 
 
     #logging.info("identified %d changes since the last run, reconciling." % len(google_drive_changes))
     logging.info("identified %d changes since the last run, reconciling." % cfg.REMOTE_QUEUE.qsize())
-    # run throught the folders first and get those created
-    '''
-    if len(google_drive_changes) > 0:
-        i = len(google_drive_changes) - 1
-        for i in reversed(range(len(google_drive_changes))):
-            if google_drive_changes[i].mimeType == 'application/vnd.google-apps.folder':
-                handle_changed_folder(service, google_drive_changes[i])
-                google_drive_changes.pop(i)
-                #i-=1 # to avoid array index issues
-
-
-        # get and process the file changes after creating any folders
-        for f in google_drive_changes:
-            if cfg.TYPE_GOOGLE_APPS not in f.mimeType:
-                handle_changed_file(service, f)
-    '''
+    # folders are created before their children by the change planner
     
 
     # ******
@@ -334,14 +355,22 @@ def main():
 
     # start remote watchers for any changs in Google Drive
     #thread_runner = threading.Thread(target=_runner, daemon=True)
-    threads = [threading.Thread(target=_worker, daemon=True)
-                for _ in range(cfg.MAX_THREADS // 2)]
+    # each lane gets its own workers so large transfers don't block small ones. changes to the
+    # same object or folder subtree are kept in order by the queue
+    threads = []
+    for lane in cfg.REMOTE_QUEUE.lane_names():
+        logging.info("Starting %d threads to handle the remote %s lane." % (cfg.REMOTE_QUEUE.lane_workers(lane), lane))
+        threads += [threading.Thread(target=_worker, args=(lane,), daemon=True)
+                    for _ in range(cfg.REMOTE_QUEUE.lane_workers(lane))]
     for t in threads:
         t.start()
     #thread_runner.start()
 
-    # sleep while the initial queue is handled
-    while (cfg.LOCAL_QUEUE.qsize() > 0 or cfg.REMOTE_QUEUE.qsize() > 0):
+    # sleep while the initial queue is handled. tasks a worker is running, tasks waiting out
+    # a retry backoff and changes the planner holds back (they're queued before the change
+    # they wait on is marked done) all count, so the token isn't saved ahead of them
+    while (cfg.LOCAL_QUEUE.unfinished_count() > 0 or cfg.REMOTE_QUEUE.unfinished_count() > 0 \
+            or retry.get_queue().pending() > 0):
         sleep(5)
 
     # clear any ignores while we were handling the initial sync
@@ -351,75 +380,56 @@ def main():
     # start tracking changes
     #global CHANGES_TOKEN
     logging.info("initial sync complete. watching for Google drive changes.")
-    logging.debug("fetching change token from google drive")
-    cfg.CHANGES_TOKEN = get_drive_changes_token(service)
+    if not caughtUp:
+        cfg.DATABASE.update_sync_state('changes_token', cfg.CHANGES_TOKEN)
+
+    # with a notification channel a change wakes the loop straight away, and polling only
+    # covers notifications that never arrive
+    notifier = None
+    backoff = notifications.PollBackoff()
+    if cfg.CHANGE_NOTIFICATIONS and not notifications.valid_address(cfg.NOTIFY_ADDRESS):
+        logging.warning("change notifications are disabled, NOTIFY_ADDRESS '%s' is not a public https url. polling only." % str(cfg.NOTIFY_ADDRESS))
+    elif cfg.CHANGE_NOTIFICATIONS:
+        notifier = notifications.ChangeNotifier()
+        notifier.start()
+        backoff = notifications.PollBackoff(maxInterval=cfg.NOTIFY_POLLING_INTERVAL_MAX)
 
     try:
         while True:
             try:
+                if notifier is not None:
+                    notifier.renew(service, cfg.CHANGES_TOKEN)
+                previousToken = cfg.CHANGES_TOKEN
                 changes = get_drive_changes(service, cfg.CHANGES_TOKEN)
+                backoff.update(len(changes) > 0)
                 logging.debug("retrieved %d changes from google drive" % len(changes))
+                logging.debug("transport: %s. pool: %s. quota: %s. concurrency: %s." % (str(transport.stats()), \
+                                str(pool.stats()), str(quota.stats()), str(transfers.concurrency_stats())))
+                logging.debug("coalescing: remote %s, local %s. debounce: %s." % (str(cfg.REMOTE_QUEUE.coalesce_stats()), \
+                                str(cfg.LOCAL_QUEUE.coalesce_stats()), \
+                                str(cfg.LOCAL_DEBOUNCER.stats() if cfg.LOCAL_DEBOUNCER is not None else None)))
                 
-                # grab full metadata for all the files first so that we can make informed decisions on the fly
+                # journal the changes with the new token and queue the objects embedded in them.
+                # a page that can't be journaled is polled again rather than skipped
                 #enrichedChanges = []
-                for change in changes:
-                    if (change['fileId'] in cfg.RQUEUE_IGNORE):
-                        cfg.RQUEUE_IGNORE.remove(change['fileId'])
-                    else:
-                        gObject = get_drive_object(service, change['fileId'])
-                        #enrichedChanges.append(gObject)
-                        if gObject.id not in cfg.RQUEUE_IGNORE:
-                            cfg.REMOTE_QUEUE.put(gObject)
-                        else:
-                            cfg.RQUEUE_IGNORE.remove(gObject.id)
+                if not queue_drive_changes(service, changes, cfg.CHANGES_TOKEN):
+                    cfg.CHANGES_TOKEN = previousToken
                
-                '''
-                # handle removes first
-                i = len(enrichedChanges) - 1
-                for i in reversed(range(len(enrichedChanges))):
-                    if enrichedChanges[i].properties['trashed']:
-                        if enrichedChanges[i].mimeType != cfg.TYPE_GOOGLE_FOLDER and cfg.TYPE_GOOGLE_APPS not in enrichedChanges[i].mimeType:
-                            handle_changed_file(service, enrichedChanges[i])
-                            changes.pop(i)
-
-                i = len(enrichedChanges) - 1
-                for i in reversed(range(len(enrichedChanges))):
-                    if enrichedChanges[i].properties['trashed']:
-                        if enrichedChanges[i].mimeType == cfg.TYPE_GOOGLE_FOLDER:
-                            handle_changed_folder(service, enrichedChanges[i])
-                            changes.pop(i)
-
-                
-                # process the folders first for additions
-                i = len(changes) -1
-                for i in reversed(range(len(changes))):
-                    full_path = ""
-                    if changes[i]['removed'] == False:
-                        if changes[i]['file']['mimeType'] == cfg.TYPE_GOOGLE_FOLDER:
-                            folder = get_drive_object(service, changes[i]['fileId']) 
-                            handle_changed_folder(service, folder)
-                            changes.pop(i)
-                    else:
-                        # handle removal of files and folders later
-                        return
-                    
-                for change in changes:
-                    if not change['removed'] == True:
-                        if cfg.TYPE_GOOGLE_APPS not in change['file']['mimeType']:
-                            file = get_drive_object(service, changes[i]['fileId'])
-                            handle_changed_file(service, file)
-
-                    else:
-                        # handle removes later
-                        return
-                '''
             except Exception as err:
                 logging.error("error parsing change set. %s" % str(err))
-            sleep(cfg.POLLING_INTERVAL)
+            delay = backoff.next_delay()
+            if notifier is not None:
+                if notifier.wait(delay):
+                    logging.debug("change notification received, pulling changes.")
+            else:
+                sleep(delay)
     except KeyboardInterrupt:
         # need to stop Observer first
         pass
 
+    if notifier is not None:
+        notifier.stop(service)
+
     cfg.OBSERVER.stop()
 
     for t in threads:
@@ -27,6 +27,8 @@ from libgdrive import gDrive
 from libdata import sqlite_store
 #from libdata.sqlite_store import *
 from lib import mods
+from lib import pool
+from lib import retry
 #from lib.mods import *
 from lib.keyring import *
 from config import config as cfg
@@ -46,21 +48,124 @@ class Change:
         self.retry = retry
 
 
+# holds the changes of locally modified files until the files have stopped changing, so only
+# the final content of a burst of saves is uploaded. a file is released to the local queue
+# once no event came for it for the quiet window and its size and mtime are still those of
+# the last event, or once it's been held for the maximum delay
+class Debouncer:
+
+    def __init__(self, quiet:float = None, maxDelay:float = None):
+        self.quiet = cfg.LOCAL_DEBOUNCE_QUIET if quiet is None else quiet
+        self.maxDelay = cfg.LOCAL_DEBOUNCE_MAX_DELAY if maxDelay is None else maxDelay
+        self.cv = threading.Condition()
+        self.pending = {}   # path -> [change, first event, last event, (size, mtime)]
+        self.absorbed = 0
+        self.released = 0
+        self.running = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    # hold a change, replacing the one already held for its path
+    def touch(self, change: Change):
+        path = change.change_object
+        stat = _file_stat(path)
+        now = time.monotonic()
+        with self.cv:
+            entry = self.pending.get(path)
+            if entry is None:
+                self.pending[path] = [change, now, now, stat]
+            else:
+                entry[0] = change
+                entry[2] = now
+                entry[3] = stat
+                self.absorbed += 1
+            self.cv.notify()
+
+    # drop the change held for a path. returns it, or None if there wasn't one
+    def forget(self, path: str) -> Change:
+        with self.cv:
+            entry = self.pending.pop(path, None)
+        return entry[0] if entry is not None else None
+
+    def _run(self):
+        with self.cv:
+            while self.running:
+                now = time.monotonic()
+                wake = None
+                for path, entry in list(self.pending.items()):
+                    change, first, last, stat = entry
+                    overdue = now >= first + self.maxDelay
+                    deadline = min(last + self.quiet, first + self.maxDelay)
+                    if deadline > now:
+                        wake = deadline if wake is None else min(wake, deadline)
+                        continue
+                    current = _file_stat(path)
+                    if current is None:
+                        # gone, its deleted or moved event takes over
+                        del self.pending[path]
+                        continue
+                    if current != stat and not overdue:
+                        # still being written without closing events, wait for another window
+                        entry[2] = now
+                        entry[3] = current
+                        wake = now + self.quiet if wake is None else min(wake, now + self.quiet)
+                        continue
+                    del self.pending[path]
+                    self.released += 1
+                    cfg.LOCAL_QUEUE.put(change)
+                self.cv.wait(None if wake is None else max(0.0, wake - now))
+
+    # release everything held and stop
+    def stop(self):
+        with self.cv:
+            self.running = False
+            for change, first, last, stat in self.pending.values():
+                cfg.LOCAL_QUEUE.put(change)
+            self.pending = {}
+            self.cv.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def stats(self) -> dict:
+        with self.cv:
+            return {"held": len(self.pending), "absorbed": self.absorbed, "released": self.released}
+
+
+# size and mtime of a file, None if it doesn't exist
+def _file_stat(path: str) -> tuple:
+    try:
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+    except OSError:
+        return None
+
+
 class Watcher:
 
     def __init__(self, service):
         self.observer = Observer()
         self.service = service
         self.thread_runner = threading.Thread(target=self._runner, daemon=True)
-        self.threads = [threading.Thread(target=self._worker, daemon=True)
-                    for _ in range(cfg.MAX_THREADS // 2)]
+        # each lane of the local queue gets its own workers. changes to the same path or folder
+        # subtree are kept in order by the queue
+        self.threads = []
+        for lane in cfg.LOCAL_QUEUE.lane_names():
+            self.threads += [threading.Thread(target=self._worker, args=(lane,), daemon=True)
+                                for _ in range(cfg.LOCAL_QUEUE.lane_workers(lane))]
         self.paused = False
+        if cfg.LOCAL_DEBOUNCE_QUIET > 0:
+            cfg.LOCAL_DEBOUNCER = Debouncer()
         
 
     def run(self):
         event_handler = Handler(self.service)
         self.observer.schedule(event_handler, os.path.join(cfg.DRIVE_CACHE_PATH, cfg.ROOT_FOLDER_OBJECT.name), recursive=True)
         self.start_queue_processor()
+        if cfg.LOCAL_DEBOUNCER is not None:
+            cfg.LOCAL_DEBOUNCER.start()
         self.observer.start()
         
         self.thread_runner.start()
@@ -89,62 +194,59 @@ class Watcher:
 
     def stop(self):
         self.observer.stop()
+        if cfg.LOCAL_DEBOUNCER is not None:
+            cfg.LOCAL_DEBOUNCER.stop()
         for t in self.threads:
             t.join()
         self.thread_runner.join()
 
-    def _worker(self, lock=threading.Lock()):
+    def _worker(self, lane:str):
 
-        # needs it's own service object for multithreading
+        # needs it's own service object for multithreading, reused for every task of this thread
         try:
-            if cfg.USE_KEYRING == True:
-                kr = Keyring()
-                tokenStr = kr.get_data("gdrive", "token")
-                if tokenStr is not None and tokenStr != "":
-                    tokenStr = json.loads(tokenStr)
-                credentials = Credentials.from_authorized_user_info(tokenStr, cfg.TARGET_SCOPES)
-            else:
-                credentials = Credentials.from_authorized_user_file(cfg.TOKEN_CACHE, cfg.TARGET_SCOPES)
-            authorized_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
-            service = discovery.build('drive', 'v3', requestBuilder=gDrive.build_request, http=authorized_http)
+            service = pool.get_service()
             #service=self.service
             # give the remote queue a chance to clear before we initialize workers
             while cfg.REMOTE_QUEUE.qsize() > 0:
                 sleep(1)
 
             while True:
+                while self.paused:
+                    sleep(1)
+                task = cfg.LOCAL_QUEUE.get(lane)
                 try:
-                    with lock:
-                        if not self.paused:
-                            task = cfg.LOCAL_QUEUE.get()
-                            if task.object_type == 'file':
-                                if task.change_type == 'created':
-                                    self.handle_file_create(service, task.change_object)
-                                elif task.change_type == 'closed':
-                                    #test_func2()
-                                    #test_func()
-                                    self.handle_file_change(service, task.change_object)
-                                elif task.change_type == 'deleted':
-                                    self.handle_file_delete(service, task.change_object)
-                                elif task.change_type == 'moved':
-                                    self.handle_file_move(service, task.change_object, task.dst_object)
-                            else:
-                                if task.change_type == 'moved':
-                                    self.handle_file_move(service, task.change_object, task.dst_object)
-                                elif task.change_type == 'created':
-                                    self.handle_dir_create(service, task.change_object)
-                                elif task.change_type == 'deleted':
-                                    self.handle_file_delete(service, task.change_object)
-                            
+                    # a pause that began while waiting for the task holds it rather than drop it
+                    while self.paused:
+                        sleep(1)
+                    if task.object_type == 'file':
+                        if task.change_type == 'created':
+                            self.handle_file_create(service, task.change_object)
+                        elif task.change_type == 'closed':
+                            #test_func2()
+                            #test_func()
+                            self.handle_file_change(service, task.change_object)
+                        elif task.change_type == 'deleted':
+                            self.handle_file_delete(service, task.change_object)
+                        elif task.change_type == 'moved':
+                            self.handle_file_move(service, task.change_object, task.dst_object)
+                    else:
+                        if task.change_type == 'moved':
+                            self.handle_file_move(service, task.change_object, task.dst_object)
+                        elif task.change_type == 'created':
+                            self.handle_dir_create(service, task.change_object)
+                        elif task.change_type == 'deleted':
+                            self.handle_file_delete(service, task.change_object)
+                    
                 except Exception as err:
-                    logging.error("Error handling queue task. %s" % str(err))
+                    retry.retry_or_dead_letter(task, err, cfg.LOCAL_QUEUE, pool.get_database(), 'local', \
+                                                task.change_object, vars(task))
                 finally:
-                    cfg.LOCAL_QUEUE.task_done()
+                    cfg.LOCAL_QUEUE.task_done(lane)
         except Exception as err:
             logging.error("Error initializing local queue worker. %s" % str(err))
 
     def start_queue_processor(self):
-        logging.info("Starting %d threads to handle local change queue." % (cfg.MAX_THREADS//2))
+        logging.info("Starting %d threads to handle local change queue." % len(self.threads))
         for t in self.threads:
             t.start()
 
@@ -172,8 +274,7 @@ class Watcher:
             #md5 = hash_file(filePath)
             # get parent directory
             parentFolder = os.path.dirname(filePath)
-            c, db_parentFolders = cfg.DATABASE.fetch_gObjectSet(searchField = "local_path", \
-                                            searchCriteria=parentFolder)
+            db_parentFolders = cfg.DATABASE.fetch_gObjects_by_path(parentFolder)
             if len(db_parentFolders) > 0:
                 db_parentFolder = self.get_latest_modified_file(db_parentFolders)
             else:
@@ -187,6 +288,8 @@ class Watcher:
             file = self.upload_drive_file(service, filePath, parent_id)
             cfg.RQUEUE_IGNORE.append(file.id)
         except Exception as err:
+            if retry.is_retryable(err):
+                raise
             logging.error("error handling local file change. %s" % str(err))
 
     def handle_file_change(self, service, filePath:str):
@@ -194,7 +297,7 @@ class Watcher:
             # hash the file
             md5 = mods.hash_file(filePath)
             # find the file in the database
-            c, dbFiles = cfg.DATABASE.fetch_gObjectSet(searchField = 'local_path', searchCriteria = filePath)
+            dbFiles = cfg.DATABASE.fetch_gObjects_by_path(filePath)
             if len(dbFiles) > 0:
                 #dbFile = dbFiles[0]
                 dbFile = self.get_latest_modified_file(dbFiles)
@@ -214,11 +317,13 @@ class Watcher:
                 # treat it as create a file
                 self.handle_file_create(service, filePath)
         except Exception as err:
+            if retry.is_retryable(err):
+                raise
             logging.error("error handling local file change. %s" % str(err))
 
     def handle_file_delete(self, service, filePath:str):
         try:
-            c, dbFiles = cfg.DATABASE.fetch_gObjectSet(searchField = 'local_path', searchCriteria = filePath)
+            dbFiles = cfg.DATABASE.fetch_gObjects_by_path(filePath)
             if len(dbFiles) > 0:
                 dbFile = dbFiles[0]
                 # upload the file to Drive if needed
@@ -228,11 +333,13 @@ class Watcher:
             else:
                 logging.error("Deleted file '%s' wasn't found in metadata database." % filePath)
         except Exception as err:
+            if retry.is_retryable(err):
+                raise
             logging.error("error deleting local file. %s" % str(err))    
 
     def handle_file_move(self, service, srcPath:str, dstPath:str):
         try:
-            c, dbFiles = cfg.DATABASE.fetch_gObjectSet(searchField = 'local_path', searchCriteria = srcPath)
+            dbFiles = cfg.DATABASE.fetch_gObjects_by_path(srcPath)
             if len(dbFiles) > 0:
                 dbFile = self.get_latest_modified_file(dbFiles)
                 if dbFile is not None:
@@ -240,10 +347,9 @@ class Watcher:
                     oldParentFolder = os.path.dirname(srcPath)
                     parentFolder = os.path.dirname(dstPath)
                     if oldParentFolder != parentFolder:
-                        c, db_parentFolders = cfg.DATABASE.fetch_gObjectSet(searchField = "local_path", \
-                                                        searchCriteria=parentFolder)
+                        db_parentFolders = cfg.DATABASE.fetch_gObjects_by_path(parentFolder)
                         db_parentFolder = None
-                        if c > 0:
+                        if len(db_parentFolders) > 0:
                             db_parentFolder = db_parentFolders[0]
                         parent_id = None
                         if db_parentFolder is not None:
@@ -275,6 +381,8 @@ class Watcher:
                 logging.error("Moved file '%s' wasn't found in metadata database." % srcPath)
 
         except Exception as err:
+            if retry.is_retryable(err):
+                raise
             logging.error("error moving file '%s'. %s" % (srcPath, str(err)))
     
     def handle_dir_change(self, service, srcPath: str):
@@ -287,8 +395,7 @@ class Watcher:
         try:
             # get parent directory
             parentFolder = os.path.dirname(srcPath)
-            c, db_parentFolders = cfg.DATABASE.fetch_gObjectSet(searchField = "local_path", \
-                                            searchCriteria=parentFolder)
+            db_parentFolders = cfg.DATABASE.fetch_gObjects_by_path(parentFolder)
             db_parentFolder = self.get_latest_modified_file(db_parentFolders)
             parent_id = None
             if db_parentFolder is not None:
@@ -298,6 +405,8 @@ class Watcher:
                 parent_id = parent.id
             folder = gDrive.create_drive_folder(service, os.path.basename(srcPath), srcPath, parent_id)
         except Exception as err:
+            if retry.is_retryable(err):
+                raise
             logging.error("Error creating directory '%s'. %s" % (srcPath, str(err)))
     
 
@@ -338,6 +447,11 @@ class Handler(FileSystemEventHandler):
                     cfg.LQUEUE_IGNORE.remove(event.src_path)
                     cfg.LQUEUE_IGNORE.remove(event.dest_path)
         else:
+            if event.src_path.endswith(cfg.DOWNLOAD_TEMP_SUFFIX):
+                # partial downloads get renamed into place by us once they complete
+                if event.event_type == 'moved' and event.dest_path in cfg.LQUEUE_IGNORE:
+                    cfg.LQUEUE_IGNORE.remove(event.dest_path)
+                return
             change_dir = os.path.dirname(event.src_path)
             #if 'lastDirectory' in Handler.__dict__:
             #    if Handler.lastDirectory == change_dir:
@@ -352,7 +466,10 @@ class Handler(FileSystemEventHandler):
                 if event.src_path not in cfg.LQUEUE_IGNORE:
                     logging.info("detected changed local file '%s'" % event.src_path)
                     change = Change(event.event_type, event.src_path, None, 'file')
-                    cfg.LOCAL_QUEUE.put(change)
+                    if cfg.LOCAL_DEBOUNCER is not None:
+                        cfg.LOCAL_DEBOUNCER.touch(change)
+                    else:
+                        cfg.LOCAL_QUEUE.put(change)
                 else:
                     cfg.LQUEUE_IGNORE.remove(event.src_path)
 
@@ -361,6 +478,9 @@ class Handler(FileSystemEventHandler):
                     logging.info("detected locally moved file '%s'" % event.src_path)
                     change=Change(event.event_type, event.src_path, event.dest_path, 'file')
                     cfg.LOCAL_QUEUE.put(change)
+                    # a change held for the old path now belongs to the new one
+                    if cfg.LOCAL_DEBOUNCER is not None and cfg.LOCAL_DEBOUNCER.forget(event.src_path) is not None:
+                        cfg.LOCAL_DEBOUNCER.touch(Change('closed', event.dest_path, None, 'file'))
                 else:
                     cfg.LQUEUE_IGNORE.remove(event.src_path)
                     cfg.LQUEUE_IGNORE.remove(event.dest_path)
@@ -368,6 +488,8 @@ class Handler(FileSystemEventHandler):
             elif event.event_type == 'deleted':
                 if event.src_path not in cfg.LQUEUE_IGNORE:
                     logging.info("detected deleted local file '%s'" % event.src_path)
+                    if cfg.LOCAL_DEBOUNCER is not None:
+                        cfg.LOCAL_DEBOUNCER.forget(event.src_path)
                     change = Change(event.event_type, event.src_path, None, 'file')
                     cfg.LOCAL_QUEUE.put(change)
                 else:
@@ -7,6 +7,7 @@ import hashlib
 import logging
 import os
 import sys
+import time
 import concurrent
 
 # application imports
@@ -19,6 +20,7 @@ from libdata import sqlite_store
 from libgdrive.gDrive import *
 from config import config as cfg
 from lib.filewatcher import *
+from lib import pool
 
 def test_func2():
     print("test function 2")
@@ -36,17 +38,46 @@ def fixup_directory(path:str)-> str:
         logging.error("Error processing config directory %s. %s" % (path, str(err)))
 
 
+# logs the time from process start to the first sync action, once
+def log_first_sync_action(action:str):
+    if cfg.PROCESS_START is None or cfg.FIRST_SYNC_ACTION is not None:
+        return
+    cfg.FIRST_SYNC_ACTION = time.monotonic() - cfg.PROCESS_START
+    logging.info("time to first sync action (%s): %.3f seconds." % (action, cfg.FIRST_SYNC_ACTION))
+
+
 # gets the md5 hash of a file
 def hash_file(filePath: str):
     hash  = hashlib.md5()
-    fileBytes  = bytearray(128*1024)
-    mv = memoryview(fileBytes)
     with open(filePath, 'rb', buffering=0) as f:
-        while n := f.readinto(mv):
-            hash.update(mv[:n])
+        hash_stream(f, hash)
     return hash.hexdigest()
 
 
+# feeds the rest of an open binary file into a hash object
+def hash_stream(f, hash):
+    fileBytes  = bytearray(128*1024)
+    mv = memoryview(fileBytes)
+    while n := f.readinto(mv):
+        hash.update(mv[:n])
+    return hash
+
+
+# wraps a writable file and hashes the bytes as they go through, so a download
+# has its md5 ready when the last chunk lands without reading the file again
+class HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.md5()
+
+    def write(self, data) -> int:
+        self.hash.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
 # clear the local folder cache
 def clear_folder_cache(folder_path: str) -> bool:
     logging.debug("clearning the local folder cache")
@@ -81,15 +112,23 @@ def read_folder_cache(folder_path: str) -> List[dict]:
     rootFolder = list(filter(lambda rf: rf['id'] == cfg.ROOT_FOLDER_ID, driveFolders))
     gDriveRoot = gFolder(rootFolder[0])
 
-    for fObj in gFolderObjects:
-        for fSearch in gFolderObjects:
-            if 'parents' in fSearch.properties.keys():
-                if fObj.id in fSearch.properties['parents']:
-                    fObj.add_child(fSearch)
+    link_folder_children(gFolderObjects)
     
     return gFolderObjects
 
 
+# attach each folder to its parents' children lists, through an id map instead of
+# searching the whole list for every folder
+def link_folder_children(folders: List[gFolder]):
+    byId = {}
+    for f in folders:
+        byId.setdefault(f.id, f)
+    for f in byId.values():
+        for parentId in f.properties.get('parents', []):
+            if parentId in byId:
+                byId[parentId].add_child(f)
+
+
 # read the local folder metadata cache into memory
 def read_folder_cache_from_db() -> List[dict]:
     logging.debug("loading folder cache objects into memory")
@@ -119,11 +158,7 @@ def read_folder_cache_from_db() -> List[dict]:
     #global ROOT_FOLDER_OBJECT
     cfg.ROOT_FOLDER_OBJECT = rootFolder
 
-    for fObj in gFolderObjects:
-        for fSearch in gFolderObjects:
-            if 'parents' in fSearch.properties.keys():
-                if fObj.id in fSearch.properties['parents']:
-                    fObj.add_child(fSearch)
+    link_folder_children(gFolderObjects)
     
     return gFolderObjects
 
@@ -134,16 +169,15 @@ def scan_local_files_mt(parentFolder:str):
         with concurrent.futures.ThreadPoolExecutor(max_workers=cfg.MAX_THREADS) as executor:
             futures = []
             for object in objects:
-                # build new database object for multi-threading too
-                threadSafeDB = sqlite_store.sqlite_store()
-                threadSafeDB.open(cfg.DATABASE_PATH)
-
+                if object.endswith(cfg.DOWNLOAD_TEMP_SUFFIX):
+                    continue
                 object = os.path.join(parentFolder, object)
                 # last modified time storec in epoch format in db for simplicity
                 last_mod:float = os.path.getmtime(object)
                 if os.path.isfile(object):
+                    # the worker uses its thread's pooled db connection
                     futures.append(executor.submit(
-                        _do_scan_local_file, object, parentFolder, threadSafeDB
+                        _do_scan_local_file, object, parentFolder
                     ))
                 elif os.path.isdir(object):
                     cfg.DATABASE.insert_localFile(object, '', 'directory', last_mod)
@@ -164,10 +198,9 @@ def _do_scan_local_file(object, parentFolder:str, threadSafeDB:sqlite_store = No
     if os.path.isfile(object):
         # multi-thread this too
         md5 = hash_file(object)
-        if threadSafeDB is not None:
-            threadSafeDB.insert_localFile(object, md5, "file", last_mod)
-        else:
-            cfg.DATABASE.insert_localFile(object, md5, "file", last_mod)
+        if threadSafeDB is None:
+            threadSafeDB = pool.get_database()
+        threadSafeDB.insert_localFile(object, md5, "file", last_mod)
     else:
         return   
 
@@ -175,6 +208,8 @@ def scan_local_files(parentFolder:str):
     try:
         objects = os.listdir(parentFolder)
         for object in objects:
+            if object.endswith(cfg.DOWNLOAD_TEMP_SUFFIX):
+                continue
             object = os.path.join(parentFolder, object)
             # last modified time storec in epoch format in db for simplicity
             last_mod:float = os.path.getmtime(object)
@@ -0,0 +1,183 @@
+# push notifications for Drive changes
+# a changes.watch channel posts to a small embedded HTTP receiver, which wakes the main loop
+# for an immediate changes.list pull. polling stays on as a fallback and backs off while the
+# drive is idle.
+# https://developers.google.com/drive/api/guides/push
+
+import http.client
+import logging
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from config import config as cfg
+
+
+# polling delay that grows while polls come back empty and resets when one finds changes
+class PollBackoff:
+
+    def __init__(self, minInterval:float = None, maxInterval:float = None):
+        self.minInterval = minInterval if minInterval is not None else cfg.POLLING_INTERVAL
+        self.maxInterval = maxInterval if maxInterval is not None else cfg.POLLING_INTERVAL_MAX
+        self.interval = self.minInterval
+
+    def update(self, foundChanges:bool):
+        if foundChanges:
+            self.interval = self.minInterval
+        else:
+            self.interval = min(self.maxInterval, self.interval * cfg.POLLING_BACKOFF)
+
+    # the next delay, jittered so that several clients don't poll in step
+    def next_delay(self) -> float:
+        return self.interval * random.uniform(1 - cfg.POLLING_JITTER, 1 + cfg.POLLING_JITTER)
+
+
+class _NotificationHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            self.rfile.read(length)
+        self.server.notifier.notify(self.headers.get('X-Goog-Channel-ID'),
+                                    self.headers.get('X-Goog-Channel-Token'),
+                                    self.headers.get('X-Goog-Resource-State'))
+        # anything but a 2xx makes Google retry the notification
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("notification receiver: " + format % args)
+
+
+# Google only delivers to a public https url, so anything else can never open a channel
+def valid_address(address:str) -> bool:
+    if not address:
+        return False
+    try:
+        parts = urlsplit(address)
+    except ValueError:
+        return False
+    return parts.scheme == 'https' and bool(parts.hostname)
+
+
+# receives changes.watch notifications and owns the channel they come from
+class ChangeNotifier:
+
+    def __init__(self, host:str = None, port:int = None, address:str = None):
+        self.host = host if host is not None else cfg.NOTIFY_LISTEN_HOST
+        self.port = port if port is not None else cfg.NOTIFY_LISTEN_PORT
+        self.address = address if address is not None else cfg.NOTIFY_ADDRESS
+        self.server = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.channelId = uuid.uuid4().hex
+        self.channelToken = secrets.token_hex(16)
+        self.resourceId = None
+        self.expiration = None
+        self.received = 0
+        self.rejected = 0
+
+    # start the receiver on a background thread
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), _NotificationHandler)
+        self.server.daemon_threads = True
+        self.server.notifier = self
+        self.port = self.server.server_address[1]
+        t = threading.Thread(target=self.server.serve_forever, daemon=True)
+        t.start()
+        logging.info("listening for google drive change notifications on %s:%d." % (self.host, self.port))
+
+    def notify(self, channelId:str, channelToken:str, state:str):
+        with self.lock:
+            if channelId != self.channelId or channelToken != self.channelToken:
+                self.rejected += 1
+                logging.warning("ignoring a change notification for an unknown channel %s." % str(channelId))
+                return
+            self.received += 1
+        # the sync message only confirms the channel was created
+        if state != 'sync':
+            self.event.set()
+
+    # open a channel for changes after pageToken
+    def watch(self, service, pageToken:str):
+        with self.lock:
+            self.channelId = uuid.uuid4().hex
+            channelId = self.channelId
+        body = {
+            "id": channelId,
+            "type": "web_hook",
+            "address": self.address,
+            "token": self.channelToken,
+            "expiration": int((time.time() + cfg.NOTIFY_CHANNEL_TTL) * 1000)
+        }
+        try:
+            channel = service.changes().watch(pageToken=pageToken, spaces='drive', body=body).execute()
+            self.resourceId = channel.get('resourceId')
+            self.expiration = int(channel.get('expiration', body['expiration'])) / 1000
+            logging.info("watching google drive changes through channel %s." % channelId)
+        except Exception as err:
+            self.expiration = None
+            logging.error("unable to open a change notification channel. %s" % str(err))
+
+    # replace the channel when it's close to expiring, or if opening it failed
+    def renew(self, service, pageToken:str):
+        if self.expiration is not None and self.expiration - time.time() > cfg.NOTIFY_RENEW_MARGIN:
+            return
+        self.close_channel(service)
+        self.watch(service, pageToken)
+
+    def close_channel(self, service):
+        if self.resourceId is None:
+            return
+        try:
+            service.channels().stop(body={"id": self.channelId, "resourceId": self.resourceId}).execute()
+        except Exception as err:
+            logging.warning("unable to stop change notification channel %s. %s" % (self.channelId, str(err)))
+        self.resourceId = None
+        self.expiration = None
+
+    # wait up to timeout seconds for a notification. returns True if one arrived
+    def wait(self, timeout:float) -> bool:
+        notified = self.event.wait(timeout)
+        self.event.clear()
+        return notified
+
+    def stop(self, service = None):
+        if service is not None:
+            self.close_channel(service)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"received": self.received, "rejected": self.rejected, "expiration": self.expiration}
+
+
+# stand-in for Google's notifier. posts a notification like the ones a changes.watch channel
+# sends, for exercising the receiver without a public address
+def send_test_notification(host:str, port:int, channelId:str, channelToken:str, state:str = 'change') -> int:
+    conn = http.client.HTTPConnection(host, port, timeout=5)
+    try:
+        conn.request('POST', '/', body=b'', headers={
+            "X-Goog-Channel-ID": channelId,
+            "X-Goog-Channel-Token": channelToken,
+            "X-Goog-Resource-State": state,
+            "X-Goog-Resource-ID": "stand-in",
+            "X-Goog-Message-Number": "1"
+        })
+        return conn.getresponse().status
+    finally:
+        conn.close()
@@ -0,0 +1,136 @@
+# per-thread pool of Drive service objects and metadata store connections
+# the google api client isn't thread safe, so every worker thread builds its own once and
+# reuses it for all of its tasks instead of building one per file.
+# https://googleapis.github.io/google-api-python-client/docs/thread_safety.html
+
+import logging
+import os
+import sys
+import threading
+import copy
+import json
+import time
+from googleapiclient import discovery
+from googleapiclient import discovery_cache
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from libdata import sqlite_store
+from libgdrive import gDrive
+from libgdrive import transport
+from config import config as cfg
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_live = {"services": 0, "connections": 0}
+
+
+# holds the clients of one thread. dropped with the thread's local storage when the
+# thread exits, which closes the clients and updates the live counters
+class _ThreadClients:
+    def __init__(self):
+        self.service = None
+        self.database = None
+
+    def close(self):
+        if self.service is not None:
+            try:
+                self.service.close()
+            except Exception as err:
+                logging.debug("error closing pooled service. %s" % str(err))
+            self.service = None
+            with _lock:
+                _live['services'] -= 1
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+            with _lock:
+                _live['connections'] -= 1
+
+    def __del__(self):
+        self.close()
+
+
+def _clients() -> _ThreadClients:
+    clients = getattr(_local, 'clients', None)
+    if clients is None:
+        clients = _ThreadClients()
+        _local.clients = clients
+    return clients
+
+
+_discoveryLock = threading.Lock()
+_discoveryDocument = None
+
+
+# the Drive v3 discovery document, loaded and parsed once per process, under _discoveryLock.
+# uses the copy shipped with the client library, then the on-disk cache, and only fetches it
+# if neither exists.
+def _discovery_document() -> dict:
+    global _discoveryDocument
+    if _discoveryDocument is not None:
+        return _discoveryDocument
+    start = time.monotonic()
+    content = discovery_cache.get_static_doc('drive', 'v3')
+    source = "client library"
+    cachePath = os.path.expanduser(cfg.DISCOVERY_CACHE_PATH)
+    if content is None and os.path.exists(cachePath):
+        with open(cachePath, 'r') as f:
+            content = f.read()
+        source = cachePath
+    if content is None:
+        http = transport.get_http()
+        resp, content = http.request(discovery.DISCOVERY_URI.format(api='drive', apiVersion='v3'))
+        if resp.status >= 400:
+            raise Exception("unable to fetch the Drive discovery document. http status %d" % resp.status)
+        content = content.decode('utf-8')
+        with open(cachePath, 'w+') as f:
+            f.write(content)
+        source = "network"
+    _discoveryDocument = json.loads(content)
+    logging.debug("loaded Drive discovery document from %s in %.3f seconds." % (source, time.monotonic() - start))
+    return _discoveryDocument
+
+
+# the Drive service object of the calling thread
+def get_service():
+    clients = _clients()
+    if clients.service is None:
+        # the client library keeps patching the document it was built from, e.g. on the first
+        # service.files() call, so every service gets its own copy of the parsed document
+        with _discoveryLock:
+            document = copy.deepcopy(_discovery_document())
+        clients.service = discovery.build_from_document(document,
+                            requestBuilder=gDrive.build_request, http=transport.get_http())
+        with _lock:
+            _live['services'] += 1
+        logging.debug("built Drive service for thread %s." % threading.current_thread().name)
+    return clients.service
+
+
+# the metadata store connection of the calling thread
+def get_database() -> sqlite_store.sqlite_store:
+    clients = _clients()
+    if clients.database is None:
+        db = sqlite_store.sqlite_store()
+        db.open(cfg.DATABASE_PATH)
+        clients.database = db
+        with _lock:
+            _live['connections'] += 1
+    return clients.database
+
+
+# close the calling thread's clients
+def release():
+    clients = getattr(_local, 'clients', None)
+    if clients is not None:
+        clients.close()
+
+
+# number of live service clients and store connections across all threads
+def stats() -> dict:
+    with _lock:
+        return dict(_live)
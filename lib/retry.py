@@ -0,0 +1,156 @@
+# retry stage for failed Drive operations
+# errors are split into retryable (429, 5xx, 403 rate limits, dropped connections) and fatal.
+# retryable tasks wait in a delayed queue and are put back on their work queue once their
+# backoff has passed, so waiting retries never hold a worker and fresh work carries on.
+# https://developers.google.com/drive/api/guides/handle-errors
+
+import email.utils
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import httplib2
+from googleapiclient.errors import HttpError
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from config import config as cfg
+
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+# the reason of the first error in a Drive error response, e.g. userRateLimitExceeded
+def error_reason(err:HttpError) -> str:
+    try:
+        content = json.loads(err.content.decode('utf-8'))
+        errors = content['error'].get('errors', [])
+        if len(errors) > 0:
+            return errors[0].get('reason', '')
+    except Exception:
+        pass
+    return ''
+
+def is_retryable(err:Exception) -> bool:
+    if isinstance(err, HttpError):
+        status = err.resp.status
+        if status in RETRYABLE_STATUS:
+            return True
+        if status == 403:
+            return error_reason(err) in cfg.RETRY_RATE_LIMIT_REASONS
+        return False
+    return isinstance(err, (socket.timeout, ConnectionError, httplib2.ServerNotFoundError))
+
+# seconds the server asked us to wait, from a Retry-After header in seconds or as a date
+def retry_after(err:Exception) -> float:
+    if not isinstance(err, HttpError):
+        return None
+    value = err.resp.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+# exponential backoff with jitter for the given attempt, never shorter than Retry-After
+def backoff_delay(attempt:int, err:Exception = None) -> float:
+    ceiling = min(cfg.RETRY_MAX_DELAY, cfg.RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    delay = random.uniform(ceiling / 2, ceiling)
+    serverDelay = retry_after(err)
+    if serverDelay is not None:
+        delay = max(delay, serverDelay)
+    return delay
+
+
+# tasks waiting out their backoff, ordered by when they're due. a single thread hands each
+# one back to its queue when it's due
+class RetryQueue:
+
+    def __init__(self):
+        self.heap = []
+        self.cv = threading.Condition()
+        self.counter = itertools.count()
+        self.thread = None
+        self.requeuing = 0      # popped from the heap and not back on their queue yet
+        self.scheduled = 0
+        self.deadLettered = 0
+
+    # call fn(*args) after delay seconds
+    def schedule(self, delay:float, fn, *args):
+        with self.cv:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), fn, args))
+            self.scheduled += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cv.notify()
+
+    # tasks waiting out their backoff, and those being handed back right now
+    def pending(self) -> int:
+        with self.cv:
+            return len(self.heap) + self.requeuing
+
+    def stats(self) -> dict:
+        with self.cv:
+            return {"pending": len(self.heap), "scheduled": self.scheduled, "dead_lettered": self.deadLettered}
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while len(self.heap) == 0 or self.heap[0][0] > time.monotonic():
+                    timeout = None if len(self.heap) == 0 else self.heap[0][0] - time.monotonic()
+                    self.cv.wait(timeout)
+                due, n, fn, args = heapq.heappop(self.heap)
+                self.requeuing += 1
+            try:
+                fn(*args)
+            except Exception as err:
+                logging.error("unable to requeue a task for retry. %s" % str(err))
+            finally:
+                with self.cv:
+                    self.requeuing -= 1
+
+
+_queue = RetryQueue()
+
+def get_queue() -> RetryQueue:
+    return _queue
+
+
+# decide what happens to a task that failed with err. called by the worker that took the task
+# from queue, before its task_done(). a retryable failure is held in the queue, so nothing put
+# after it on the same ids or paths runs first, and goes back in at its original place once
+# its backoff has passed. fatal failures and tasks out of attempts are written to the dead
+# letter table. the attempt count is kept on task.retry. returns True if the task will run again
+def retry_or_dead_letter(task, err:Exception, queue, db, kind:str, objectId:str, payload) -> bool:
+    attempts = getattr(task, 'retry', 0) + 1
+    task.retry = attempts
+    if is_retryable(err) and attempts < cfg.RETRY_MAX_ATTEMPTS:
+        delay = backoff_delay(attempts, err)
+        logging.warning("%s task for %s failed on attempt %d, retrying in %.1f seconds. %s" % \
+                            (kind, str(objectId), attempts, delay, str(err)))
+        _queue.schedule(delay, queue.hold(), task)
+        return True
+
+    if is_retryable(err):
+        logging.error("%s task for %s failed after %d attempts. %s" % (kind, str(objectId), attempts, str(err)))
+    else:
+        logging.error("%s task for %s failed. %s" % (kind, str(objectId), str(err)))
+    with _queue.cv:
+        _queue.deadLettered += 1
+    if db is not None:
+        db.insert_dead_letter(kind, objectId, json.dumps(payload, default=str), str(err), attempts)
+    return False
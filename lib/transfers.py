@@ -0,0 +1,594 @@
+# transfer scheduling for gdrive_sync
+# one tree-wide work queue so that every transfer slot stays busy across folder boundaries,
+# split into lanes by size. how many transfers a lane runs at once is set by an AIMD
+# controller from throughput, latency and the congestion signals of the transport.
+
+import logging
+import os
+import sys
+import collections
+import contextvars
+import threading
+import time
+import weakref
+from typing import List
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from lib import pool
+from lib import retry
+from libgdrive import transport
+from config import config as cfg
+
+
+# throughput may dip this much between adjustments and still count as holding up
+THROUGHPUT_SLACK = 0.1
+
+_controllers = weakref.WeakSet()
+# controller of the lane whose task the current thread is running, so a congestion signal
+# from one of its requests only slows that lane down
+_activeController = contextvars.ContextVar("activeController", default=None)
+
+
+# additive increase, multiplicative decrease of the number of tasks a lane runs at once.
+# workers take a slot before they pick up a task and give it back when the task is done.
+class ConcurrencyController:
+
+    def __init__(self, name:str, minimum:int, maximum:int, level:int = None):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        if level is None:
+            level = (self.maximum + 1) // 2
+        self.level = min(self.maximum, max(self.minimum, level))
+        self.cv = threading.Condition()
+        self.held = 0
+        self.busy = 0
+        self.increases = 0
+        self.decreases = 0
+        self.lastThroughput = None
+        self.baseLatency = None
+        self.lastDecrease = 0.0
+        self._reset_window(time.monotonic())
+        _controllers.add(self)
+
+    def _reset_window(self, now:float):
+        self.windowStart = now
+        self.units = 0
+        self.latencySum = 0.0
+        self.samples = 0
+        self.peakBusy = self.busy
+        self.congested = False
+
+    # wait for a free slot
+    def acquire(self):
+        with self.cv:
+            self._adjust()
+            while self.held >= self.level:
+                self.cv.wait(cfg.CONCURRENCY_INTERVAL)
+                self._adjust()
+            self.held += 1
+
+    # the slot holder started a task
+    def started(self):
+        with self.cv:
+            self.busy += 1
+            self.peakBusy = max(self.peakBusy, self.busy)
+
+    # give the slot back. latency and units (bytes, at least 1 per task) describe the task it
+    # ran, if any
+    def release(self, latency:float = None, units:int = 0):
+        with self.cv:
+            self.held -= 1
+            if latency is not None:
+                self.busy -= 1
+                self.units += max(1, units)
+                self.latencySum += latency
+                self.samples += 1
+            self._adjust()
+            self.cv.notify_all()
+
+    # multiplicative decrease, at most once per interval so a burst of errors counts once
+    def congestion(self, reason:str):
+        with self.cv:
+            now = time.monotonic()
+            self.congested = True
+            if now - self.lastDecrease < cfg.CONCURRENCY_INTERVAL:
+                return
+            self.lastDecrease = now
+            level = max(self.minimum, int(self.level * cfg.CONCURRENCY_DECREASE))
+            if level < self.level:
+                logging.info("%s concurrency down from %d to %d after %s." % (self.name, self.level, level, reason))
+                self.level = level
+                self.decreases += 1
+
+    # additive increase once per interval, for a lane that used all of its slots while
+    # throughput held up and latency stayed flat. needs self.cv held
+    def _adjust(self):
+        now = time.monotonic()
+        elapsed = now - self.windowStart
+        if elapsed < cfg.CONCURRENCY_INTERVAL:
+            return
+        if self.samples > 0 and not self.congested:
+            throughput = self.units / elapsed
+            latency = self.latencySum / self.samples
+            if self.baseLatency is None or latency < self.baseLatency:
+                self.baseLatency = latency
+            flat = latency <= self.baseLatency * (1 + cfg.CONCURRENCY_LATENCY_TOLERANCE)
+            holding = self.lastThroughput is None or throughput >= self.lastThroughput * (1 - THROUGHPUT_SLACK)
+            if self.peakBusy >= self.level and flat and holding and self.level < self.maximum:
+                self.level += 1
+                self.increases += 1
+                logging.debug("%s concurrency up to %d. %.1f units/s, %.3fs latency." % \
+                                (self.name, self.level, throughput, latency))
+            self.lastThroughput = throughput
+            # let the baseline drift up so one quick window doesn't hold growth back for good
+            self.baseLatency = self.baseLatency * (1 + cfg.CONCURRENCY_LATENCY_TOLERANCE / 4)
+        self._reset_window(now)
+        self.cv.notify_all()
+
+    def stats(self) -> dict:
+        with self.cv:
+            return {
+                "level": self.level,
+                "min": self.minimum,
+                "max": self.maximum,
+                "busy": self.busy,
+                "increases": self.increases,
+                "decreases": self.decreases
+            }
+
+
+# requests made outside of any lane's task, like the changes poll, aren't tied to a lane and
+# are left to their own retry backoff
+def _on_congestion(reason:str):
+    controller = _activeController.get()
+    if controller is not None:
+        controller.congestion(reason)
+
+transport.add_congestion_listener(_on_congestion)
+
+# current level of every live controller, by queue and lane
+def concurrency_stats() -> dict:
+    return {c.name: c.stats() for c in list(_controllers)}
+
+
+# a work queue split into lanes by transfer size, each drained by its own workers, so small
+# files aren't stuck behind a handful of multi-GB transfers. the interface follows queue.Queue
+# except that get() and task_done() take the lane being worked. a lane has a worker thread per
+# slot, and its controller decides how many of them may hold a task at once.
+# items can carry keys, the file ids and local paths they touch. an item is only handed out
+# once every item put before it on the same id, on the same path or on an ancestor or
+# descendant path is done, so work on one file or folder subtree keeps its submission order
+# while unrelated items run in parallel. an item held for a retry keeps its place in that order.
+# with a coalescer, items that get the same coalescing key are folded together: an item put
+# while another with its key is still waiting replaces it or is dropped, as the merger
+# decides, and one put while another with its key is running is dropped when the merger keeps
+# the running one, until its worker calls detach(). the default merger keeps the latest item.
+class LaneQueue:
+
+    def __init__(self, sizer=None, lanes:List[dict] = None, name:str = "queue", keyer=None, \
+                    coalescer=None, merger=None):
+        if lanes is None:
+            lanes = cfg.TRANSFER_LANES
+        self.lanes = lanes
+        self.sizer = sizer
+        self.keyer = keyer
+        self.coalescer = coalescer
+        self.merger = merger if merger is not None else _keep_latest
+        self.name = name
+        self.cv = threading.Condition()
+        self.seq = 0
+        self.queues = {}        # lane -> entries waiting, (seq, item, size, ids, paths, key, lane)
+        self.unfinished = {}    # seq -> entry, for every item put and not done yet
+        self.byId = {}          # id -> seqs of the items with that id
+        self.byPath = {}        # path -> seqs of the items at that path
+        self.below = {}         # path -> seqs of the items beneath that path
+        self.pending = {}       # coalescing key -> entry waiting
+        self.running = {}       # coalescing key -> item running
+        self.coalesced = 0
+        self.attached = 0
+        self.controllers = {}
+        self.local = threading.local()
+        for lane in self.lanes:
+            self.queues[lane['name']] = collections.deque()
+            self.controllers[lane['name']] = ConcurrencyController(name + "." + lane['name'], \
+                                                cfg.CONCURRENCY_MIN, max(1, lane['workers']))
+
+    def lane_names(self) -> List[str]:
+        return [lane['name'] for lane in self.lanes]
+
+    def lane_workers(self, name:str) -> int:
+        for lane in self.lanes:
+            if lane['name'] == name:
+                return max(1, lane['workers'])
+        return 1
+
+    # first lane whose max_size the transfer fits under. the last lane takes everything else
+    def lane_for(self, size:int) -> str:
+        for lane in self.lanes:
+            if lane['max_size'] is None or size <= lane['max_size']:
+                return lane['name']
+        return self.lanes[-1]['name']
+
+    def put(self, item, size:int = None):
+        if size is None:
+            size = self.sizer(item) if self.sizer is not None else 0
+        ids, paths = self.keyer(item) if self.keyer is not None else ((), ())
+        key = self.coalescer(item) if self.coalescer is not None else None
+        self._put(self.lane_for(size), item, size, ids, paths, key)
+
+    def put_lane(self, name:str, item):
+        self._put(name, item, 0, (), ())
+
+    def _put(self, lane:str, item, size:int, ids, paths, key = None):
+        paths = [os.path.normpath(p) for p in paths if p]
+        with self.cv:
+            if key is not None and not self._coalesce(key, item):
+                return
+            self.seq += 1
+            entry = (self.seq, item, size, tuple(i for i in ids if i), tuple(paths), key, lane)
+            self.unfinished[self.seq] = entry
+            if key is not None:
+                self.pending[key] = entry
+            for id in entry[3]:
+                self.byId.setdefault(id, collections.deque()).append(self.seq)
+            for path in entry[4]:
+                self.byPath.setdefault(path, collections.deque()).append(self.seq)
+                for ancestor in _ancestors(path):
+                    self.below.setdefault(ancestor, collections.deque()).append(self.seq)
+            self.queues[lane].append(entry)
+            self.cv.notify_all()
+
+    # fold an item into the waiting or running item with the same coalescing key. returns
+    # False if the item isn't needed any more. needs self.cv held
+    def _coalesce(self, key, item) -> bool:
+        existing = self.pending.get(key)
+        if existing is not None:
+            self.coalesced += 1
+            if self.merger(existing[1], item, False) is existing[1]:
+                return False
+            self._discard(existing)
+            return True
+        running = self.running.get(key)
+        if running is not None and self.merger(running, item, True) is running:
+            self.attached += 1
+            return False
+        return True
+
+    # take a waiting entry out of the queue. needs self.cv held
+    def _discard(self, entry:tuple):
+        self.queues[entry[6]].remove(entry)
+        self.unfinished.pop(entry[0], None)
+        if self.pending.get(entry[5]) is entry:
+            del self.pending[entry[5]]
+
+    # seq of the oldest unfinished item under key in index. needs self.cv held
+    def _oldest(self, index:dict, key:str) -> int:
+        seqs = index.get(key)
+        if seqs is None:
+            return None
+        while len(seqs) > 0 and seqs[0] not in self.unfinished:
+            seqs.popleft()
+        if len(seqs) == 0:
+            del index[key]
+            return None
+        return seqs[0]
+
+    def _blocked(self, seq:int, index:dict, key:str) -> bool:
+        oldest = self._oldest(index, key)
+        return oldest is not None and oldest < seq
+
+    # an entry is ready when nothing put before it touches the same id or a related path
+    def _ready(self, entry:tuple) -> bool:
+        seq, item, size, ids, paths = entry[:5]
+        for id in ids:
+            if self._blocked(seq, self.byId, id):
+                return False
+        for path in paths:
+            if self._blocked(seq, self.below, path) or self._blocked(seq, self.byPath, path):
+                return False
+            for ancestor in _ancestors(path):
+                if self._blocked(seq, self.byPath, ancestor):
+                    return False
+        return True
+
+    # first ready entry of the lane. a stop marker (None) waits until it's first in its lane
+    def _take(self, name:str) -> tuple:
+        entries = self.queues[name]
+        for i, entry in enumerate(entries):
+            if entry[1] is None:
+                if i > 0:
+                    return None
+            elif not self._ready(entry):
+                continue
+            del entries[i]
+            if entry[5] is not None:
+                if self.pending.get(entry[5]) is entry:
+                    del self.pending[entry[5]]
+                self.running[entry[5]] = entry[1]
+            return entry
+        return None
+
+    # waits for a slot in the lane, then for an item that's free to run
+    def get(self, name:str):
+        controller = self.controllers[name]
+        controller.acquire()
+        with self.cv:
+            entry = self._take(name)
+            while entry is None:
+                self.cv.wait()
+                entry = self._take(name)
+        seq, item, size, ids, paths, key, lane = entry
+        if item is not None:
+            controller.started()
+            _activeController.set(controller)
+            self.local.started = (seq, time.monotonic(), size, key, item)
+        else:
+            self.local.started = (seq, None, 0, None, None)
+        return item
+
+    # keep the item this thread is running unfinished after task_done(), so its ids and paths
+    # stay held and nothing put after it on them can overtake it while it waits for a retry.
+    # returns requeue(item), which puts it back in its lane at the place its sequence number
+    # gives it
+    def hold(self):
+        seq = self.local.started[0]
+        self.local.held = True
+        with self.cv:
+            entry = self.unfinished[seq]
+
+        def requeue(item):
+            with self.cv:
+                entries = self.queues[entry[6]]
+                i = 0
+                while i < len(entries) and entries[i][0] < entry[0]:
+                    i += 1
+                entries.insert(i, entry)
+                self.cv.notify_all()
+        return requeue
+
+    # stop folding new items into the item this thread is running. whatever the merger attached
+    # to it so far stays, so a worker reads what it has to settle after calling this
+    def detach(self):
+        seq, started, size, key, item = self.local.started
+        with self.cv:
+            if key is not None and self.running.get(key) is item:
+                del self.running[key]
+
+    def task_done(self, name:str):
+        seq, started, size, key, item = self.local.started
+        held = getattr(self.local, 'held', False)
+        self.local.started = None
+        self.local.held = False
+        _activeController.set(None)
+        with self.cv:
+            if not held:
+                self.unfinished.pop(seq, None)
+            if key is not None and self.running.get(key) is item:
+                del self.running[key]
+            self.cv.notify_all()
+        if started is not None:
+            self.controllers[name].release(time.monotonic() - started, size)
+        else:
+            self.controllers[name].release()
+
+    def concurrency(self) -> dict:
+        return {name: c.stats()['level'] for name, c in self.controllers.items()}
+
+    def qsize(self) -> int:
+        with self.cv:
+            return sum(len(q) for q in self.queues.values())
+
+    def lane_sizes(self) -> dict:
+        with self.cv:
+            return {name: len(q) for name, q in self.queues.items()}
+
+    def coalesce_stats(self) -> dict:
+        with self.cv:
+            return {"coalesced": self.coalesced, "attached": self.attached}
+
+    # items put and not done yet, including the ones running
+    def unfinished_count(self) -> int:
+        with self.cv:
+            return len(self.unfinished)
+
+    def join(self):
+        with self.cv:
+            self.cv.wait_for(lambda: len(self.unfinished) == 0)
+
+
+# merger that keeps the item put last
+def _keep_latest(existing, item, running:bool):
+    return item
+
+
+# every folder above a path, nearest first
+def _ancestors(path:str) -> List[str]:
+    ancestors = []
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        ancestors.append(parent)
+        path = parent
+        parent = os.path.dirname(path)
+    return ancestors
+
+
+# size of a Drive object for lane selection. folders and native docs count as small
+def remote_item_size(gObject) -> int:
+    try:
+        return int(gObject.properties.get('size', 0))
+    except Exception:
+        return 0
+
+# size of a local change for lane selection
+def local_item_size(change) -> int:
+    try:
+        if change.object_type == 'file' and os.path.isfile(change.change_object):
+            return os.path.getsize(change.change_object)
+    except Exception:
+        pass
+    return 0
+
+
+# ordering keys of a Drive object, its id and the local paths it's at now and will be at.
+# the paths come from the namespace index, a new object's from its parent folder
+def remote_item_keys(gObject) -> tuple:
+    paths = []
+    if cfg.NAMESPACE is not None:
+        node = cfg.NAMESPACE.node(gObject.id)
+        if node is not None and node[2]:
+            paths.append(node[2])
+        parents = gObject.properties.get('parents', [])
+        parent = cfg.NAMESPACE.node(parents[0]) if len(parents) > 0 else None
+        if parent is not None and parent[2] and gObject.name:
+            paths.append(os.path.join(parent[2], gObject.name))
+    return [gObject.id], paths
+
+# ordering keys of a local change, the paths it touches
+def local_item_keys(change) -> tuple:
+    return [], [change.change_object, getattr(change, 'dst_object', None)]
+
+
+def _version(gObject) -> int:
+    try:
+        return int(gObject.properties.get('version', 0))
+    except Exception:
+        return 0
+
+# coalescing key of a Drive object, its id
+def remote_item_key(gObject) -> str:
+    return gObject.id
+
+# keeps the newer of two changes of the same Drive object, taking over the journal entries
+# and planned changes of the other. a change for an object that's being applied is dropped
+# unless it's newer or other changes wait for it
+def merge_remote_items(existing, item, running:bool):
+    newer = _version(item) > _version(existing)
+    if running:
+        if newer or len(getattr(item, 'dependents', [])) > 0 or len(getattr(item, 'subtree', [])) > 0:
+            return item
+        keep, other = existing, item
+    elif newer or _version(item) == _version(existing):
+        keep, other = item, existing
+    else:
+        keep, other = existing, item
+    journalIds = [j for j in (getattr(keep, 'journalId', None), getattr(other, 'journalId', None)) if j is not None]
+    if len(journalIds) > 0:
+        keep.journalId = max(journalIds)
+    if not running:
+        keep.dependents = getattr(keep, 'dependents', []) + getattr(other, 'dependents', [])
+        keep.subtree = getattr(keep, 'subtree', []) + getattr(other, 'subtree', [])
+    return keep
+
+# coalescing key of a local change. repeated saves of a file fold together, other changes
+# are kept as they are
+def local_item_key(change) -> tuple:
+    if change.object_type == 'file' and change.change_type in ('closed', 'modified'):
+        return ('modified', change.change_object)
+    return None
+
+
+# a queued transfer, with the number of attempts it has failed so far
+class _Transfer:
+    def __init__(self, fn, args:tuple, size:int):
+        self.fn = fn
+        self.args = args
+        self.size = size
+        self.retry = 0
+
+
+class TransferScheduler:
+
+    def __init__(self, lanes:List[dict] = None):
+        self.queue = LaneQueue(lanes=lanes, name="transfers")
+        self.threads = []
+        self.cv = threading.Condition()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        for lane in self.queue.lane_names():
+            workers = self.queue.lane_workers(lane)
+            logging.info("starting %d transfer workers for the %s lane." % (workers, lane))
+            for _ in range(workers):
+                t = threading.Thread(target=self._worker, args=(lane,), daemon=True)
+                t.start()
+                self.threads.append((lane, t))
+
+    # queue a transfer of size bytes. fn is called with args on a worker of the matching lane
+    def submit(self, fn, *args, size:int = 0):
+        with self.cv:
+            self.queued += 1
+        self.queue.put(_Transfer(fn, args, size), size)
+
+    def stats(self) -> dict:
+        with self.cv:
+            return {
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "lanes": self.queue.lane_sizes(),
+                "concurrency": self.queue.concurrency()
+            }
+
+    # block until nothing is queued or running. returns False if the timeout expires first
+    def wait(self, timeout:float = None) -> bool:
+        with self.cv:
+            return self.cv.wait_for(lambda: self.queued == 0 and self.active == 0, timeout)
+
+    # wait for all transfers, logging progress every interval
+    def join(self, interval:float = None):
+        if interval is None:
+            interval = cfg.TRANSFER_STATS_INTERVAL
+        while not self.wait(interval):
+            s = self.stats()
+            p = pool.stats()
+            logging.info("transfers: %d queued %s, %d active, %d completed, %d failed, concurrency %s. %d clients, %d db connections live." % \
+                            (s['queued'], str(s['lanes']), s['active'], s['completed'], s['failed'], \
+                            str(s['concurrency']), p['services'], p['connections']))
+
+    def stop(self):
+        for lane, _ in self.threads:
+            self.queue.put_lane(lane, None)
+        for _, t in self.threads:
+            t.join()
+        self.threads = []
+
+    def _worker(self, lane:str):
+        while True:
+            task = self.queue.get(lane)
+            try:
+                if task is None:
+                    pool.release()
+                    return
+                with self.cv:
+                    self.queued -= 1
+                    self.active += 1
+                failed = False
+                retrying = False
+                try:
+                    result = task.fn(*task.args)
+                    logging.debug("transfer result: %s" % str(result))
+                except Exception as err:
+                    objectId = getattr(task.args[0], 'id', None) if len(task.args) > 0 else None
+                    retrying = retry.retry_or_dead_letter(task, err, self.queue, pool.get_database(), \
+                                                        'transfer', objectId, [str(a) for a in task.args])
+                    failed = not retrying
+                with self.cv:
+                    self.active -= 1
+                    # a transfer waiting out a retry backoff still counts as queued, so join() waits for it
+                    if retrying:
+                        self.queued += 1
+                    elif failed:
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+                    self.cv.notify_all()
+            finally:
+                self.queue.task_done(lane)
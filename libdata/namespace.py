@@ -0,0 +1,224 @@
+# in-memory views of the Drive namespace, used to build local paths without walking the
+# parents of every object over the API and to look objects up by local path without
+# scanning the metadata db
+
+import logging
+import os
+import sys
+import threading
+from typing import List
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from libdata.data_types import *
+from config import config as cfg
+
+
+# resolves the path of a folder relative to the drive cache directory, in the same form as
+# gDrive.get_full_folder_path, from the namespace index. the index memoizes the paths and drops
+# them for a folder and everything below it when it's renamed or moved. only ancestors it
+# doesn't know are fetched from the API.
+class PathResolver:
+
+    def __init__(self, index):
+        self.index = index
+        self.lock = threading.Lock()
+        self.apiLookups = 0
+
+    # path of the folder with this id
+    def path_of(self, service, id:str) -> str:
+        return self.index.folder_path(id, lambda unknownId: self._fetch_node(service, unknownId))
+
+    # path of a folder object. the object can be newer than the index, e.g. a rename that's
+    # being applied, so its own name and parent are used
+    def folder_path(self, service, folder) -> str:
+        parents = folder.properties.get('parents', [])
+        if len(parents) == 0:
+            return _top_path(folder.name, folder.properties.get('ownedByMe', True))
+        return self.path_of(service, parents[0]) + "/" + folder.name
+
+    # name, parent ids and ownedByMe of a folder that isn't indexed
+    def _fetch_node(self, service, id:str) -> tuple:
+        params = { "fileId": id, "fields": cfg.PATH_FIELDS }
+        object = service.files().get(**params).execute()
+        with self.lock:
+            self.apiLookups += 1
+        return (object['name'], object.get('parents', []), object.get('ownedByMe', True))
+
+    def stats(self) -> dict:
+        with self.lock:
+            apiLookups = self.apiLookups
+        return {"memoized": self.index.stats()['memoized'], "api_lookups": apiLookups}
+
+
+# top level folders go under the drive cache directory, or under _shared_withme when they
+# belong to someone else
+def _top_path(name:str, ownedByMe) -> str:
+    if ownedByMe is False or ownedByMe == 0:
+        return "_shared_withme/" + name
+    return name
+
+
+# id <-> path index over the gObjects and relationships tables, shared by every worker and
+# store connection. sqlite_store keeps it current on each insert, update and delete, so
+# watcher and change handler lookups by local path don't scan the table. it also memoizes
+# folder paths for the PathResolver.
+class NamespaceIndex:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.nodes = {}     # id -> (name, mimeType, local path, parent ids, ownedByMe)
+        self.byPath = {}    # local path -> set of ids
+        self.children = {}  # parent id -> set of child ids
+        self.paths = {}     # id -> memoized folder path
+        self.generation = 0 # bumped whenever memoized paths are dropped
+
+    # load every object from the metadata db
+    def load(self, db, rows = None):
+        if rows is None:
+            rows = db.fetch_namespace_rows()
+        with self.lock:
+            for id, name, mimeType, localPath, parentId, ownedByMe in rows:
+                node = self.nodes.get(id)
+                parents = node[3] if node is not None else ()
+                if parentId is not None and parentId not in parents:
+                    parents = parents + (parentId, )
+                self._set(id, name, mimeType, localPath, parents, ownedByMe)
+        logging.debug("namespace index loaded %d objects." % len(self.nodes))
+
+    # drop everything and load again. the rows are read before taking the index lock, so the
+    # store's lock is always taken first
+    def reload(self, db):
+        rows = db.fetch_namespace_rows()
+        with self.lock:
+            self.nodes = {}
+            self.byPath = {}
+            self.children = {}
+            self.paths = {}
+            self.generation += 1
+            self.load(db, rows)
+
+    def _set(self, id:str, name:str, mimeType:str, localPath:str, parents:tuple, ownedByMe):
+        ownedByMe = ownedByMe is not False and ownedByMe != 0
+        previous = self.nodes.get(id)
+        if previous is not None:
+            self._unlink(id, previous)
+            if (previous[0], previous[3], previous[4]) != (name, parents, ownedByMe):
+                self._invalidate(id)
+        self.nodes[id] = (name, mimeType, localPath, parents, ownedByMe)
+        if localPath:
+            self.byPath.setdefault(localPath, set()).add(id)
+        for parentId in parents:
+            self.children.setdefault(parentId, set()).add(id)
+
+    def _unlink(self, id:str, node:tuple):
+        ids = self.byPath.get(node[2])
+        if ids is not None:
+            ids.discard(id)
+            if len(ids) == 0:
+                del self.byPath[node[2]]
+        for parentId in node[3]:
+            children = self.children.get(parentId)
+            if children is not None:
+                children.discard(id)
+                if len(children) == 0:
+                    del self.children[parentId]
+
+    # drop the memoized paths of an object and all of its descendants. needs self.lock held
+    def _invalidate(self, id:str):
+        self.generation += 1
+        pending = [id]
+        while len(pending) > 0:
+            current = pending.pop()
+            self.paths.pop(current, None)
+            pending.extend(self.children.get(current, ()))
+
+    # add or update an object. parents=None keeps the parents already indexed and
+    # ownedByMe=None the ownership
+    def upsert(self, id:str, name:str, mimeType:str, localPath:str, parents:List[str] = None, ownedByMe = None):
+        with self.lock:
+            node = self.nodes.get(id)
+            if parents is None:
+                parents = node[3] if node is not None else ()
+            if ownedByMe is None:
+                ownedByMe = node[4] if node is not None else True
+            self._set(id, name, mimeType, localPath, tuple(parents), ownedByMe)
+
+    # add or update an object known from a Drive listing, keeping the local path it's
+    # indexed with
+    def upsert_remote(self, id:str, name:str, mimeType:str, parents:List[str], ownedByMe = None):
+        with self.lock:
+            node = self.nodes.get(id)
+            self.upsert(id, name, mimeType, node[2] if node is not None else None, parents, ownedByMe)
+
+    def set_parents(self, id:str, parents:List[str]):
+        with self.lock:
+            node = self.nodes.get(id)
+            if node is not None:
+                self._set(id, node[0], node[1], node[2], tuple(parents), node[4])
+
+    def remove(self, id:str):
+        with self.lock:
+            node = self.nodes.pop(id, None)
+            if node is not None:
+                self._unlink(id, node)
+                self._invalidate(id)
+
+    # ids of the objects stored at this local path
+    def ids_for_path(self, localPath:str) -> List[str]:
+        with self.lock:
+            return list(self.byPath.get(localPath, ()))
+
+    def node(self, id:str) -> tuple:
+        with self.lock:
+            return self.nodes.get(id)
+
+    def children_of(self, id:str) -> List[str]:
+        with self.lock:
+            return list(self.children.get(id, ()))
+
+    # path of the folder with this id. folders that aren't indexed are looked up with
+    # fetch(id), which returns (name, parent ids, ownedByMe), and indexed without a local path
+    def folder_path(self, id:str, fetch) -> str:
+        with self.lock:
+            if id in self.paths:
+                return self.paths[id]
+            generation = self.generation
+        # walk up until a memoized path or the top of the tree. the lock isn't held while
+        # fetching, so paths are only memoized if nothing was invalidated in the meantime
+        chain = []
+        seen = set()
+        current = id
+        basePath = None
+        while current is not None:
+            if current in seen:
+                raise Exception("cycle in folder parents at id %s" % current)
+            seen.add(current)
+            with self.lock:
+                if current in self.paths:
+                    basePath = self.paths[current]
+                    break
+                node = self.nodes.get(current)
+            if node is None:
+                name, parents, ownedByMe = fetch(current)
+                self.upsert_remote(current, name, cfg.TYPE_GOOGLE_FOLDER, parents, ownedByMe)
+                node = self.node(current)
+            chain.append((current, node[0], node[4]))
+            current = node[3][0] if len(node[3]) > 0 else None
+
+        with self.lock:
+            path = basePath
+            for nodeId, name, ownedByMe in reversed(chain):
+                if path is None:
+                    path = _top_path(name, ownedByMe)
+                else:
+                    path = path + "/" + name
+                if self.generation == generation:
+                    self.paths[nodeId] = path
+            return path
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"objects": len(self.nodes), "paths": len(self.byPath), "memoized": len(self.paths)}
@@ -9,6 +9,7 @@ import sys
 import os
 import threading
 import datetime
+import functools
 
 
 current = os.path.dirname(os.path.realpath(__file__))
@@ -17,13 +18,24 @@ sys.path.append(parent)
 from libdata.data_types import *
 from config import config as cfg
 
+# run a store method under the store's lock
+def _synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class sqlite_store:
     def __init__(self):
         self.conn = None
         self.cursor = None
-        self.lock = threading.Lock()
+        # the connection and its transactions are shared by every thread using the store, so
+        # each method runs under this lock on a cursor of its own
+        self.lock = threading.RLock()
         return
 
+    @_synchronized
     def __create_schema(self):
         logging.debug("creating database schema.")
         try:
@@ -55,16 +67,18 @@ class sqlite_store:
                                 id integer PRIMARY KEY, \
                                 deleted_id text NOT NULL);"
 
-            self.cursor = self.conn.cursor()
-            self.cursor.execute(gObjectTable_sql)
+            cursor = self.conn.cursor()
+            cursor.execute(gObjectTable_sql)
             self.conn.commit()
-            self.cursor.execute(parentChildrenTable_sql)
+            cursor.execute(parentChildrenTable_sql)
             self.conn.commit()
-            self.cursor.execute(localFiles_sql)
+            cursor.execute(localFiles_sql)
             self.conn.commit()
-            self.cursor.execute(deleted_files_sql)
+            cursor.execute(deleted_files_sql)
             self.conn.commit()
 
+            self.__create_state_tables()
+
             # files that exist locally but not in drive (via the db)
             views_sql = "CREATE VIEW IF NOT EXISTS v_files_local_but_not_in_db \
                             AS \
@@ -81,7 +95,7 @@ class sqlite_store:
                             OR gObjects.local_path is null) \
                             AND local_files.mime_type != 'directory';"
 
-            self.cursor.execute(views_sql)
+            cursor.execute(views_sql)
             self.conn.commit()
 
             #files where local files are newer than the files in drive and hashes don't match
@@ -99,7 +113,7 @@ class sqlite_store:
                             AND local_files.path = gObjects.local_path \
                             WHERE cast(strftime('%s', json_extract(gObjects.properties, '$.modifiedTime')) as integer) < \
                             cast(local_files.last_mod as integer);"
-            self.cursor.execute(views_sql)
+            cursor.execute(views_sql)
             self.conn.commit()
 
         except sqlite3.Error as error:
@@ -107,11 +121,50 @@ class sqlite_store:
         except Exception as err:
             logging.error("error creating database schema %s." % str(err))
 
+    # tables added after the original schema. safe to run against existing databases.
+    @_synchronized
+    def __create_state_tables(self):
+        try:
+            downloads_sql = "CREATE TABLE IF NOT EXISTS downloads (\
+                                file_id nvarchar(100) PRIMARY KEY, \
+                                temp_path text NOT NULL, \
+                                bytes_done integer NOT NULL, \
+                                md5_checksum text, \
+                                version text);"
+            syncState_sql = "CREATE TABLE IF NOT EXISTS sync_state (\
+                                key text PRIMARY KEY, \
+                                value text);"
+            changeJournal_sql = "CREATE TABLE IF NOT EXISTS change_journal (\
+                                id integer PRIMARY KEY AUTOINCREMENT, \
+                                file_id nvarchar(100) NOT NULL, \
+                                change text NOT NULL);"
+            deadLetters_sql = "CREATE TABLE IF NOT EXISTS dead_letters (\
+                                id integer PRIMARY KEY, \
+                                kind text NOT NULL, \
+                                object_id text, \
+                                payload text, \
+                                error text, \
+                                attempts integer NOT NULL, \
+                                failed_at real NOT NULL);"
+            cursor = self.conn.cursor()
+            cursor.execute(downloads_sql)
+            cursor.execute(syncState_sql)
+            cursor.execute(changeJournal_sql)
+            cursor.execute(deadLetters_sql)
+            self.conn.commit()
+
+        except sqlite3.Error as e:
+            logging.error("error creating state tables. %s" % str(e))
+        except Exception as e:
+            logging.error("error creating state tables. %s" % str(e))
+
+    @_synchronized
     def clear_local_files(self):
         logging.debug("clearing the local_files table")
         try:
+            cursor = self.conn.cursor()
             truncateLocalFiles_sql = "DELETE FROM local_files;"
-            self.cursor.execute(truncateLocalFiles_sql)
+            cursor.execute(truncateLocalFiles_sql)
             self.conn.commit()
         
         except sqlite3.Error as e:
@@ -120,6 +173,7 @@ class sqlite_store:
             logging.error("Unable to truncate the local_files table. %s" % str(e))
 
 
+    @_synchronized
     def create_db(self, dbPath: str):
         logging.debug("creating database %s" % dbPath)
         try:
@@ -130,15 +184,16 @@ class sqlite_store:
         except Exception as e:
             logging.error("unable to create databaase %s. %s" % (dbPath, str(e)))
 
+    @_synchronized
     def fetch_gObject(self, id: str):
         logging.debug("fetching database object with id %s" % id)
         objects = []
         try:
-            self.lock.acquire(True)
+            cursor = self.conn.cursor()
             fetchObject_sql = "SELECT id, name, mime_type, properties, md5, local_path FROM gObjects WHERE id = ?;"
             sqlParams = (id, )
-            self.cursor.execute(fetchObject_sql, sqlParams)
-            rows = self.cursor.fetchall()
+            cursor.execute(fetchObject_sql, sqlParams)
+            rows = cursor.fetchall()
         
             for row in rows:
                 if row[2] == 'application/vnd.google-apps.folder':
@@ -155,19 +210,19 @@ class sqlite_store:
             logging.error("Unable to fetch object id %s. %s" % (id, str(e)))
         except Exception as e:
             logging.error("Unable to fetch object id %s. %s" % (id, str(e)))
-        finally:
-            self.lock.release()
 
         return objects
 
+    @_synchronized
     def fetch_parents(self, id: str):
         parents = []
         try:
+            cursor = self.conn.cursor()
             fetchObject_sql = "SELECT * FROM relationships WHERE child_id = ?;"
             sqlParams = (id, ) 
 
-            self.cursor.execute(fetchObject_sql, sqlParams)
-            rows = self.cursor.fetchall()
+            cursor.execute(fetchObject_sql, sqlParams)
+            rows = cursor.fetchall()
         
             for row in rows:
                 parents.append(row[1])
@@ -180,11 +235,46 @@ class sqlite_store:
 
         return parents
 
+    # id, name, mime type, local path, parent id and ownedByMe of every object, one row per
+    # parent, without decoding the properties blobs
+    @_synchronized
+    def fetch_namespace_rows(self):
+        rows = []
+        try:
+            fetch_sql = "SELECT gObjects.id, gObjects.name, gObjects.mime_type, gObjects.local_path, \
+                            relationships.parent_id, json_extract(gObjects.properties, '$.ownedByMe') \
+                        FROM gObjects \
+                        LEFT JOIN relationships ON relationships.child_id = gObjects.id;"
+            cursor = self.conn.cursor()
+            cursor.execute(fetch_sql)
+            rows = cursor.fetchall()
+
+        except sqlite3.Error as e:
+            logging.error("Unable to fetch namespace rows. %s" % str(e))
+        except Exception as e:
+            logging.error("Unable to fetch namespace rows. %s" % str(e))
+
+        return rows
+
+    # objects stored at a local path. answered from the namespace index when it's loaded,
+    # otherwise from a scan of the gObjects table
+    @_synchronized
+    def fetch_gObjects_by_path(self, localPath: str):
+        if cfg.NAMESPACE is None:
+            c, objects = self.fetch_gObjectSet(searchField = 'local_path', searchCriteria = localPath)
+            return objects
+        objects = []
+        for id in cfg.NAMESPACE.ids_for_path(localPath):
+            objects.extend(self.fetch_gObject(id))
+        return objects
+
+    @_synchronized
     def fetch_newLocalFiles(self, pageSize:int = 100, offset:int = 0):
         logging.debug("fetching files that exist locally but not in the cloud.")
         results = []
         totalFetched = 0
         try:
+            cursor = self.conn.cursor()
             fetch_sql = "SELECT id, \
                             path, \
                             md5, \
@@ -192,8 +282,8 @@ class sqlite_store:
                             last_mod \
                         FROM v_files_local_but_not_in_db LIMIT ? OFFSET ?;"
             sqlParams = (pageSize, offset)
-            self.cursor.execute(fetch_sql, sqlParams)
-            rows = self.cursor.fetchall()
+            cursor.execute(fetch_sql, sqlParams)
+            rows = cursor.fetchall()
             for row in rows:
                 try:
                     if row[3] == 'directory':
@@ -230,11 +320,13 @@ class sqlite_store:
         return totalFetched, results
 
 
+    @_synchronized
     def mark_changedLocalFiles(self):
         logging.debug("Incrementing the version on locally changed files.")
         try:
+            cursor = self.conn.cursor()
             # start a transaction for atomicity
-            self.cursor.execute("BEGIN")
+            cursor.execute("BEGIN")
 
             # increment the version of the file
             update_sql = "UPDATE gObjects \
@@ -243,23 +335,25 @@ class sqlite_store:
                             WHERE id IN ( \
                             SELECT id FROM v_files_modified_locally);"
 
-            self.cursor.execute(update_sql)
+            cursor.execute(update_sql)
             self.conn.commit()
 
         except sqlite3.Error as e:
             logging.error("Unable to increment version on changed files. %s" % str(e))
-            self.cursor.execute("ROLLBACK;")
+            self.conn.rollback()
         except Exception as e:
             logging.error("Unable to increment version on changed files. %s" % str(e))
-            self.cursor.execute("ROLLBACK;")
+            self.conn.rollback()
 
 
 
+    @_synchronized
     def fetch_changedLocalFiles(self, pageSize:int = 100, offset:int = 0):
         logging.debug("fetching local files that are newer vs what's in the cloud.")
         results = []
         totalFetched = 0
         try:
+            cursor = self.conn.cursor()
             fetch_sql = "SELECT id, \
                             local_path, \
                             md5, \
@@ -268,8 +362,8 @@ class sqlite_store:
                             properties \
                         FROM v_files_modified_locally LIMIT ? OFFSET ?;"
             sqlParams = (pageSize, offset)
-            self.cursor.execute(fetch_sql, sqlParams)
-            rows = self.cursor.fetchall()
+            cursor.execute(fetch_sql, sqlParams)
+            rows = cursor.fetchall()
             for row in rows:
                 try:
                     if row[3] == cfg.TYPE_GOOGLE_FOLDER:
@@ -305,10 +399,12 @@ class sqlite_store:
         
         return totalFetched, results
     
+    @_synchronized
     def fetch_gObjectSet(self, pageSize:int = 100, offset:int=0, searchField:str = None, searchCriteria:str=None):
         gObjects = []
         totalFetched = 0
         try:
+            cursor = self.conn.cursor()
             fetchObjects_sql = "SELECT id, name, mime_type, md5, local_path, properties FROM gObjects "
             if searchField is not None and searchCriteria is not None:
                 fetchObjects_sql =  fetchObjects_sql + "WHERE " + searchField + " LIKE ? "
@@ -316,8 +412,8 @@ class sqlite_store:
             else:
                 sqlParams = (pageSize, offset)
             fetchObjects_sql =  fetchObjects_sql + " LIMIT ? OFFSET ?;"
-            self.cursor.execute(fetchObjects_sql, sqlParams)
-            rows = self.cursor.fetchall()
+            cursor.execute(fetchObjects_sql, sqlParams)
+            rows = cursor.fetchall()
 
             for row in rows:
                 mimeType = row[2]
@@ -344,10 +440,12 @@ class sqlite_store:
         return totalFetched, gObjects
 
 
+    @_synchronized
     def fetch_deletedObjects(self, pageSize:int = 100, offset:int=0):
         gObjects = []
         totalFetched = 0
         try:
+            cursor = self.conn.cursor()
             # there are duplicate files in Google drive, some of which are deleted
             # we just need to be careful about removing local files if there are 
             # versions of the file that arent' deleted. 
@@ -363,8 +461,8 @@ class sqlite_store:
                                     ) LIMIT ? OFFSET ?; '
 
             sqlParams = (pageSize, offset)
-            self.cursor.execute(fetchObjects_sql, sqlParams)
-            rows = self.cursor.fetchall()
+            cursor.execute(fetchObjects_sql, sqlParams)
+            rows = cursor.fetchall()
 
             for row in rows:
                 mimeType = row[2]
@@ -390,6 +488,7 @@ class sqlite_store:
 
         return gObjects, totalFetched
 
+    @_synchronized
     def insert_gObject(self, folder:gFolder = None, file:gFile = None):
         if folder is not None and file is not None:
             raise("invalid parameter set.  supply folder or file option, not both.")
@@ -399,8 +498,10 @@ class sqlite_store:
             self.__insert_gFile(file)
 
 
+    @_synchronized
     def __insert_gFolder(self, folder: gFolder):
         try:
+            cursor = self.conn.cursor()
             f = self.fetch_gObject(folder.id)
             if len(f) == 1:
                 f[0].properties = folder.properties
@@ -413,16 +514,19 @@ class sqlite_store:
                 procInsertObject_sql = "INSERT INTO gObjects\
                                         (id, name, mime_type, local_path, properties) VALUES (?, ?, ?, ?, ?);"
                 sqlParams = (folder.id, folder.name, folder.mimeType, folder.localPath, json.dumps(folder.properties))
-                self.cursor.execute(procInsertObject_sql, sqlParams)
+                cursor.execute(procInsertObject_sql, sqlParams)
                 self.conn.commit()
+                self.__index_gObject(folder)
         except sqlite3.Error as e:
 
             logging.error("unable to insert folder %s into database. %s" % (folder.name, str(e)))
         except Exception as e:
             logging.error("unable to insert folder %s into database. %s" % (folder.name, str(e)))
 
+    @_synchronized
     def __insert_gFile(self, file: gFile):
         try:
+            cursor = self.conn.cursor()
             f = self.fetch_gObject(file.id)
             if len(f) == 1:
                 f[0].md5 = file.md5
@@ -435,8 +539,9 @@ class sqlite_store:
                 procInsertObject_sql = "INSERT INTO gObjects\
                                         (id, name, mime_type, properties, md5, local_path) VALUES (?, ?, ?, ?, ?, ?);"
                 sqlParams = (file.id, file.name, file.mimeType, json.dumps(file.properties), file.md5, file.localPath)
-                self.cursor.execute(procInsertObject_sql, sqlParams)
+                cursor.execute(procInsertObject_sql, sqlParams)
                 self.conn.commit()
+                self.__index_gObject(file)
 
             if 'parents' in file.properties.keys():
                 self.insert_parents(file.id, file.properties['parents'])
@@ -448,8 +553,41 @@ class sqlite_store:
         except Exception as e:
             logging.error("unable to insert file %s into database. %s" % (file.name, str(e)))
 
+    # insert or replace many objects and their parent links in one transaction
+    @_synchronized
+    def bulk_insert_gObjects(self, objects: List):
+        try:
+            cursor = self.conn.cursor()
+            insertObjects_sql = "INSERT OR REPLACE INTO gObjects\
+                                    (id, name, mime_type, properties, md5, local_path) VALUES (?, ?, ?, ?, ?, ?);"
+            sqlParams = [(o.id, o.name, o.mimeType, json.dumps(o.properties), getattr(o, 'md5', None), o.localPath) \
+                            for o in objects]
+            cursor.executemany(insertObjects_sql, sqlParams)
+
+            deleteParents_sql = "DELETE FROM relationships WHERE child_id = ?;"
+            cursor.executemany(deleteParents_sql, [(o.id, ) for o in objects])
+
+            insertRelationships_sql = "INSERT INTO relationships (parent_id, child_id) VALUES (?, ?);"
+            sqlParams = [(parent, o.id) for o in objects for parent in o.properties.get('parents', [])]
+            cursor.executemany(insertRelationships_sql, sqlParams)
+            self.conn.commit()
+
+            if cfg.NAMESPACE is not None:
+                for o in objects:
+                    cfg.NAMESPACE.upsert(o.id, o.name, o.mimeType, o.localPath, o.properties.get('parents', []), \
+                                            o.properties.get('ownedByMe'))
+
+        except sqlite3.Error as e:
+            logging.error("Unable to bulk insert %d objects. %s" % (len(objects), str(e)))
+            self.conn.rollback()
+        except Exception as e:
+            logging.error("Unable to bulk insert %d objects. %s" % (len(objects), str(e)))
+            self.conn.rollback()
+
+    @_synchronized
     def insert_parents(self, id:str, parents: List[str]):
         try:
+            cursor = self.conn.cursor()
             existing_parents = sorted(self.fetch_parents(id))
             parents = sorted(parents)
             if existing_parents == parents:
@@ -461,19 +599,23 @@ class sqlite_store:
                 for parent in parents:
                     procInsertRelationships_sql = "INSERT INTO relationships (parent_id, child_id) VALUES (?, ?);"
                     sqlParams = (parent, id)
-                    self.cursor.execute(procInsertRelationships_sql, sqlParams)
+                    cursor.execute(procInsertRelationships_sql, sqlParams)
                 self.conn.commit()
+                if cfg.NAMESPACE is not None:
+                    cfg.NAMESPACE.set_parents(id, parents)
 
         except sqlite3.Error as e:
             logging.error("Unable to insert parents for object id %s. %s" % (id, str(e)))
         except Exception as e:
             logging.error("Unable to insert parents for object id %s. %s" % (id, str(e))) 
                 
+    @_synchronized
     def insert_localFile(self, path:str, md5: str, mime_type:str, last_mod: float):
         try:
+            cursor = self.conn.cursor()
             insert_localFile_sql = "INSERT INTO local_files (path, md5, mime_type, last_mod) values (?, ?, ?, ?);"
             sqlParams = (path, md5, mime_type, last_mod)
-            self.cursor.execute(insert_localFile_sql, sqlParams)
+            cursor.execute(insert_localFile_sql, sqlParams)
             self.conn.commit()
 
         except sqlite3.Error as e:
@@ -481,6 +623,7 @@ class sqlite_store:
         except Exception as e:
             logging.error("Unable to insert parents for object id %s. %s" % (id, str(e))) 
     
+    @_synchronized
     def update_gObject(self, folder: gFolder = None, file: gFile = None):
         if folder is not None and file is not None:
             raise("invalid parameter set.  supply folder or file option, not both.")
@@ -489,13 +632,17 @@ class sqlite_store:
         else:
             self.__update_gFile(file)
 
+    @_synchronized
     def delete_gObject(self, id:str):
         try:
+            cursor = self.conn.cursor()
             deleteObject_sql = "DELETE FROM gObjects WHERE id = ?;"
             sqlParams = (id,)
     
-            self.cursor.execute(deleteObject_sql, sqlParams)
+            cursor.execute(deleteObject_sql, sqlParams)
             self.conn.commit()
+            if cfg.NAMESPACE is not None:
+                cfg.NAMESPACE.remove(id)
 
         except sqlite3.Error as e:
             logging.error("Unable to delete object id %s. %s" % (id, str(e)))
@@ -503,13 +650,16 @@ class sqlite_store:
             logging.error("Unable to delete object id %s. %s" % (id, str(e)))
 
 
+    @_synchronized
     def __update_gFolder(self, folder: gFolder):
         try:
+            cursor = self.conn.cursor()
             updateObject_sql = "UPDATE gObjects SET name = ?, properties = ?, local_path = ? WHERE id = ?;"
             sqlParams = (folder.name, json.dumps(folder.properties), folder.localPath, folder.id)
     
-            self.cursor.execute(updateObject_sql, sqlParams)
+            cursor.execute(updateObject_sql, sqlParams)
             self.conn.commit()
+            self.__index_gObject(folder)
 
             if 'parents' in folder.properties.keys():
                 self.update_parents(folder.id, folder.properties['parents'])
@@ -519,13 +669,16 @@ class sqlite_store:
         except Exception as e:
             logging.error("Unable to update folder object id %s. %s" % (id, str(e)))
 
+    @_synchronized
     def __update_gFile(self, file: gFile):
         try:
+            cursor = self.conn.cursor()
             updateObject_sql = "UPDATE gObjects SET name = ?, properties = ?, md5 = ?, local_path = ? WHERE id = ?;"
             sqlParams = (file.name, json.dumps(file.properties), file.md5, file.localPath, file.id)
     
-            self.cursor.execute(updateObject_sql, sqlParams)
+            cursor.execute(updateObject_sql, sqlParams)
             self.conn.commit()
+            self.__index_gObject(file)
             
 
             if 'parents' in file.properties.keys():
@@ -538,12 +691,20 @@ class sqlite_store:
         except Exception as e:
             logging.error("Unable to fetch object id %s. %s" % (id, str(e)))
 
+    # keep the shared namespace index in step with a written object
+    @_synchronized
+    def __index_gObject(self, object):
+        if cfg.NAMESPACE is not None:
+            cfg.NAMESPACE.upsert(object.id, object.name, object.mimeType, object.localPath, \
+                                    object.properties.get('parents'), object.properties.get('ownedByMe'))
+
+    @_synchronized
     def update_parents(self, id:str, parents: List[str]):
         try:
-            self.lock.acquire(True)
+            cursor = self.conn.cursor()
             deleteParents_sql = "DELETE FROM relationships WHERE child_id = ?;"
             sqlParams = (id, )
-            self.cursor.execute(deleteParents_sql, sqlParams)
+            cursor.execute(deleteParents_sql, sqlParams)
             self.conn.commit()
             
             self.insert_parents(id, parents)
@@ -552,31 +713,31 @@ class sqlite_store:
             logging.error("Unable to update parents for object id %s. %s" % (id, str(e)))
         except Exception as e:
             logging.error("Unable to update parents for object id %s. %s" % (id, str(e))) 
-        finally:
-            self.lock.release()
 
+    @_synchronized
     def identify_local_deleted(self):
         try:
+            cursor = self.conn.cursor()
             # start a transaction for atomicity
-            self.cursor.execute("BEGIN")
+            cursor.execute("BEGIN")
 
             # empty the table with deleted gObjects id
             update_sql = "DELETE FROM local_deleted;"
-            self.cursor.execute(update_sql)
+            cursor.execute(update_sql)
 
             # insert the deleted files ids into the temp table
             update_sql = "INSERT INTO local_deleted (deleted_id)\
                             SELECT gObjects.id FROM gObjects \
                             LEFT JOIN local_files ON gObjects.local_path = local_files.path \
                             WHERE local_files.path IS null;"
-            self.cursor.execute(update_sql)
+            cursor.execute(update_sql)
 
             # set the files trashed attribute to true
             update_sql = "UPDATE gObjects \
                             SET properties = json_patch(properties, '{" + '"' + 'trashed"' + ":true}') \
                             WHERE id IN ( \
                             SELECT deleted_id FROM local_deleted);"
-            self.cursor.execute(update_sql)
+            cursor.execute(update_sql)
 
             # increment the version of the file
             update_sql = "UPDATE gObjects \
@@ -585,27 +746,29 @@ class sqlite_store:
                             WHERE gObjects.id IN ( \
                                 SELECT deleted_id FROM local_deleted) \
                             AND json_extract(properties, '$.version') > 0;"
-            self.cursor.execute(update_sql)
+            cursor.execute(update_sql)
             # commit the transaction if successful
             self.conn.commit()          
 
         except sqlite3.Error as e:
             logging.error("Unable to update metadata for locally deleted files. %s" % str(e))
-            self.cursor.execute("ROLLBACK;")
+            self.conn.rollback()
         except Exception as e:
             logging.error("Unable to update metadata for locally deleted files. %s" % str(e))
-            self.cursor.execute("ROLLBACK;") 
+            self.conn.rollback() 
 
+    @_synchronized
     def get_files_deleted_from_disk(self, pageSize:int = 100, offset:int = 0):
         deleted_objects = []
         totalFetched = 0
         try:
+            cursor = self.conn.cursor()
             fetch_sql = "SELECT gObjects.id, name, mime_type, md5, local_path, properties FROM gObjects \
                             INNER JOIN local_deleted ON gObjects.id = local_deleted.deleted_id LIMIT ? OFFSET ?;"
 
             sqlParams = (pageSize, offset)
-            self.cursor.execute(fetch_sql, sqlParams)
-            rows = self.cursor.fetchall()
+            cursor.execute(fetch_sql, sqlParams)
+            rows = cursor.fetchall()
             for row in rows:
                 try:
                     if row[2] == cfg.TYPE_GOOGLE_FOLDER:
@@ -628,8 +791,10 @@ class sqlite_store:
         return totalFetched, deleted_objects
 
 
+    @_synchronized
     def delete_files_not_on_disk(self):
         try:
+            cursor = self.conn.cursor()
 
             delete_sql = 'DELETE FROM gObjects \
                             WHERE id IN (\
@@ -641,7 +806,7 @@ class sqlite_store:
                             AND local_files.mime_type = "file" \
                             AND gObjects.mime_type NOT LIKE "%folder%" \
                             AND json_extract(properties, "$.trashed") = 0);'
-            self.cursor.execute(delete_sql)
+            cursor.execute(delete_sql)
             self.conn.commit()
 
             delete_sql = 'DELETE from gObjects \
@@ -650,7 +815,7 @@ class sqlite_store:
                             AND gObjects.local_path IS NOT null \
                             AND gObjects.mime_type NOT LIKE "%folder%" \
                             AND json_extract(gObjects.properties, "$.trashed") = 0;'
-            self.cursor.execute(delete_sql)
+            cursor.execute(delete_sql)
             self.conn.commit()
 
             delete_sql = 'DELETE FROM gObjects \
@@ -662,24 +827,186 @@ class sqlite_store:
                             AND local_files.mime_type = "directory" \
                             AND gObjects.mime_type LIKE "%folder%" \
                             AND json_extract(properties, "$.trashed") = 0);'
-            self.cursor.execute(delete_sql)
+            cursor.execute(delete_sql)
             self.conn.commit()
 
+            # bulk deletes, so rebuild the index rather than tracking each id
+            if cfg.NAMESPACE is not None:
+                cfg.NAMESPACE.reload(self)
+
         except sqlite3.Error as e:
             logging.error("Error deleting files not on disk. %s" % (id, str(e)))
         except Exception as e:
             logging.error("Error deleting files not on disk. %s" % (id, str(e)))
 
 
+    @_synchronized
+    def fetch_download_progress(self, id: str) -> dict:
+        progress = None
+        try:
+            fetch_sql = "SELECT file_id, temp_path, bytes_done, md5_checksum, version FROM downloads WHERE file_id = ?;"
+            sqlParams = (id, )
+            cursor = self.conn.cursor()
+            cursor.execute(fetch_sql, sqlParams)
+            row = cursor.fetchone()
+            if row is not None:
+                progress = {
+                    "file_id": row[0],
+                    "temp_path": row[1],
+                    "bytes_done": row[2],
+                    "md5_checksum": row[3],
+                    "version": row[4]
+                }
+        except sqlite3.Error as e:
+            logging.error("Unable to fetch download progress for id %s. %s" % (id, str(e)))
+        except Exception as e:
+            logging.error("Unable to fetch download progress for id %s. %s" % (id, str(e)))
+
+        return progress
+
+    @_synchronized
+    def update_download_progress(self, id: str, tempPath: str, bytesDone: int, md5Checksum: str, version: str):
+        try:
+            upsert_sql = "INSERT OR REPLACE INTO downloads (file_id, temp_path, bytes_done, md5_checksum, version) \
+                            VALUES (?, ?, ?, ?, ?);"
+            sqlParams = (id, tempPath, bytesDone, md5Checksum, version)
+            cursor = self.conn.cursor()
+            cursor.execute(upsert_sql, sqlParams)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("Unable to update download progress for id %s. %s" % (id, str(e)))
+        except Exception as e:
+            logging.error("Unable to update download progress for id %s. %s" % (id, str(e)))
+
+    @_synchronized
+    def delete_download_progress(self, id: str):
+        try:
+            delete_sql = "DELETE FROM downloads WHERE file_id = ?;"
+            sqlParams = (id, )
+            cursor = self.conn.cursor()
+            cursor.execute(delete_sql, sqlParams)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("Unable to delete download progress for id %s. %s" % (id, str(e)))
+        except Exception as e:
+            logging.error("Unable to delete download progress for id %s. %s" % (id, str(e)))
+
+    @_synchronized
+    def fetch_sync_state(self, key: str) -> str:
+        value = None
+        try:
+            fetch_sql = "SELECT value FROM sync_state WHERE key = ?;"
+            sqlParams = (key, )
+            cursor = self.conn.cursor()
+            cursor.execute(fetch_sql, sqlParams)
+            row = cursor.fetchone()
+            if row is not None:
+                value = row[0]
+        except sqlite3.Error as e:
+            logging.error("Unable to fetch sync state %s. %s" % (key, str(e)))
+        except Exception as e:
+            logging.error("Unable to fetch sync state %s. %s" % (key, str(e)))
+
+        return value
+
+    @_synchronized
+    def update_sync_state(self, key: str, value: str):
+        try:
+            upsert_sql = "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?);"
+            sqlParams = (key, value)
+            cursor = self.conn.cursor()
+            cursor.execute(upsert_sql, sqlParams)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("Unable to update sync state %s. %s" % (key, str(e)))
+        except Exception as e:
+            logging.error("Unable to update sync state %s. %s" % (key, str(e)))
+
+    # write a page of Drive changes to the journal and move the changes token past them in the
+    # same transaction. returns file id -> id of the latest journal entry for that file, or None
+    # if nothing was written and the stored token wasn't moved
+    @_synchronized
+    def journal_changes(self, changes: List[dict], token: str) -> dict:
+        journalIds = {}
+        try:
+            cursor = self.conn.cursor()
+            insert_sql = "INSERT INTO change_journal (file_id, change) VALUES (?, ?);"
+            for change in changes:
+                cursor.execute(insert_sql, (change['fileId'], json.dumps(change)))
+                journalIds[change['fileId']] = cursor.lastrowid
+            if token is not None:
+                upsert_sql = "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?);"
+                cursor.execute(upsert_sql, ('changes_token', token))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("Unable to journal %d changes. %s" % (len(changes), str(e)))
+            self.conn.rollback()
+            journalIds = None
+        except Exception as e:
+            logging.error("Unable to journal %d changes. %s" % (len(changes), str(e)))
+            self.conn.rollback()
+            journalIds = None
+
+        return journalIds
+
+    # changes still waiting to be applied, file id -> (latest journal id, latest change)
+    @_synchronized
+    def fetch_change_journal(self) -> dict:
+        journal = {}
+        try:
+            fetch_sql = "SELECT id, file_id, change FROM change_journal ORDER BY id;"
+            cursor = self.conn.cursor()
+            cursor.execute(fetch_sql)
+            for row in cursor.fetchall():
+                journal[row[1]] = (row[0], json.loads(row[2]))
+        except sqlite3.Error as e:
+            logging.error("Unable to fetch the change journal. %s" % str(e))
+        except Exception as e:
+            logging.error("Unable to fetch the change journal. %s" % str(e))
+
+        return journal
+
+    # drop the journal entries of a file up to and including journalId, once applied
+    @_synchronized
+    def delete_journal_entries(self, id: str, journalId: int):
+        try:
+            delete_sql = "DELETE FROM change_journal WHERE file_id = ? AND id <= ?;"
+            sqlParams = (id, journalId)
+            cursor = self.conn.cursor()
+            cursor.execute(delete_sql, sqlParams)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("Unable to delete journal entries for id %s. %s" % (id, str(e)))
+        except Exception as e:
+            logging.error("Unable to delete journal entries for id %s. %s" % (id, str(e)))
+
+    # record a task that won't be retried any more
+    @_synchronized
+    def insert_dead_letter(self, kind: str, objectId: str, payload: str, error: str, attempts: int):
+        try:
+            insert_sql = "INSERT INTO dead_letters (kind, object_id, payload, error, attempts, failed_at) \
+                            VALUES (?, ?, ?, ?, ?, ?);"
+            sqlParams = (kind, objectId, payload, error, attempts, datetime.datetime.now().timestamp())
+            cursor = self.conn.cursor()
+            cursor.execute(insert_sql, sqlParams)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("Unable to record dead letter for %s. %s" % (objectId, str(e)))
+        except Exception as e:
+            logging.error("Unable to record dead letter for %s. %s" % (objectId, str(e)))
+
+    @_synchronized
     def open(self, dbPath: str):
         try:
             self.conn = sqlite3.connect(dbPath, check_same_thread=False)
             self.cursor = self.conn.cursor()
+            self.__create_state_tables()
         except sqlite3.Error as error:
             logging.error("error closing database. %s" % str(e))
         except Exception as e:
             logging.error("error closing database. %s" % str(e))
     
+    @_synchronized
     def close(self):
         try:
             self.conn.close()
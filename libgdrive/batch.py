@@ -0,0 +1,73 @@
+# batching layer over the Drive batch endpoint
+# groups metadata gets into batches of up to BATCH_MAX_SIZE calls per round trip. items that
+# fail inside a batch are retried as single requests.
+# https://developers.google.com/drive/api/guides/performance#batch-requests
+
+import logging
+import os
+import sys
+from typing import List
+from googleapiclient.errors import HttpError
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from libdata.data_types import *
+from config import config as cfg
+
+
+# run (key, request) pairs through the batch endpoint. returns the responses and the errors
+# of the items that still failed after their single request fallback, both keyed by key
+def execute_batched(service, requests: List) -> tuple:
+    responses = {}
+    errors = {}
+    for i in range(0, len(requests), cfg.BATCH_MAX_SIZE):
+        chunk = requests[i:i + cfg.BATCH_MAX_SIZE]
+        failed = []
+
+        def callback(request_id, response, exception):
+            key, request = chunk[int(request_id)]
+            if exception is None:
+                responses[key] = response
+            else:
+                failed.append((key, request, exception))
+
+        try:
+            batch = service.new_batch_http_request(callback=callback)
+            for n, (key, request) in enumerate(chunk):
+                batch.add(request, request_id=str(n))
+            batch.execute()
+        except Exception as err:
+            logging.warning("batch request of %d items failed, falling back to single requests. %s" % (len(chunk), str(err)))
+            failed = [(key, request, err) for key, request in chunk if key not in responses]
+
+        for key, request, exception in failed:
+            # a missing object won't appear on a second try
+            if isinstance(exception, HttpError) and exception.resp.status == 404:
+                errors[key] = exception
+                continue
+            try:
+                responses[key] = request.execute()
+            except Exception as err:
+                errors[key] = err
+
+    return responses, errors
+
+
+# fetch the metadata of many objects. returns id -> gFile/gFolder for the ones found
+def batch_get_drive_objects(service, ids: List[str], fields:str = None) -> dict:
+    if fields is None:
+        fields = cfg.CHANGE_FIELDS
+    objects = {}
+    gServiceFiles = service.files()
+    requests = [(id, gServiceFiles.get(fileId=id, fields=fields)) for id in dict.fromkeys(ids)]
+    responses, errors = execute_batched(service, requests)
+    for id, object in responses.items():
+        if object['mimeType'] == cfg.TYPE_GOOGLE_FOLDER:
+            objects[id] = gFolder(object)
+        else:
+            objects[id] = gFile(object)
+    for id, err in errors.items():
+        logging.error("Unable to fetch metadata from google drive for object id %s. %s" % (id, str(err)))
+    return objects
@@ -5,14 +5,12 @@ import os
 import io
 import concurrent.futures
 import shutil
+import hashlib
 from time import sleep
 #import keyring
 
 # google and http imports
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 from googleapiclient.http import MediaFileUpload
@@ -30,6 +28,12 @@ from libdata.sqlite_store import *
 from lib import mods
 from lib import keyring
 from lib import filewatcher
+from lib import transfers
+from lib import pool
+from lib import retry
+from libgdrive import transport
+from libgdrive import batch
+from libgdrive import planner
 from config import config as cfg
 #from lib.mods import *
 
@@ -91,6 +95,8 @@ def login_to_drive():
         logging.warning("valid credentials weren't found, initializing oauth consent from in default browser.")
         try:
             if creds and creds.expired and creds.refresh_token:
+                # only loaded when a token has to be refreshed, to keep startup light
+                from google.auth.transport.requests import Request
                 try:
                     creds.refresh(Request())
                 except HttpError as err:
@@ -107,6 +113,8 @@ def login_to_drive():
                         return
                     logging.error("error logging in to Google Drive. %s" % str(err))  
             else:
+                # only loaded for interactive consent
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file(cfg.APP_CREDS, cfg.TARGET_SCOPES)
                 creds = flow.run_local_server(port=0)
             # Save the credentials for the next run
@@ -121,12 +129,11 @@ def login_to_drive():
     
     return creds
 
-# Create a new Http() object for every request
+# Use the calling thread's keep-alive Http() object for the class of each request
 # https://googleapis.github.io/google-api-python-client/docs/thread_safety.html
 # overrides the constructor of the http2 object 
 def build_request(http, *args, **kwargs):
-    new_http = google_auth_httplib2.AuthorizedHttp(cfg.CREDENTIALS, http=httplib2.Http())
-    return googleapiclient.http.HttpRequest(new_http, *args, **kwargs)
+    return transport.DriveRequest(http, *args, **kwargs)
 
 # get the root folder
 def get_root_folder(service) -> gFolder:
@@ -134,7 +141,8 @@ def get_root_folder(service) -> gFolder:
     rootFolder = None
     try:
         gServiceFiles = service.files()
-        params = { "fileId": 'root'
+        params = { "fileId": 'root',
+                    "fields": cfg.OBJECT_FIELDS
         }       
         request = gServiceFiles.get(**params)
         rootFolderResult =request.execute()
@@ -159,17 +167,26 @@ def print_folder_tree(folders = None):
     printTree(rootFolder[0], 0)
     return
 
+# local path of a folder relative to the drive cache directory. there's no partial answer: if
+# an ancestor can't be resolved the error is raised rather than placing the folder by name only
 def get_full_folder_path(service, folder: gFolder)-> str:
     full_path = str(folder.name)
+    if cfg.PATH_RESOLVER is not None:
+        try:
+            return cfg.PATH_RESOLVER.folder_path(service, folder)
+        except Exception as err:
+            if not retry.is_retryable(err):
+                logging.error("Error getting full local path for folder id %s. %s" % (folder.id, str(err)))
+            raise
     try:
         if 'parents' in folder.properties.keys():   
             gServiceFiles = service.files()
-            params = { "fileId": folder.properties['parents'][0], "fields": "parents, mimeType, id, name, ownedByMe"}
+            params = { "fileId": folder.properties['parents'][0], "fields": cfg.PATH_FIELDS}
             request = gServiceFiles.get(**params)
             parent = request.execute()
             full_path = parent['name'] + "/" + full_path
             while 'parents' in parent.keys():
-                params = { "fileId": parent['parents'][0], "fields": "parents, mimeType, id, name, ownedByMe"}
+                params = { "fileId": parent['parents'][0], "fields": cfg.PATH_FIELDS}
                 request = gServiceFiles.get(**params)
                 parent = request.execute()
                 full_path = parent['name'] + "/" + full_path
@@ -184,14 +201,212 @@ def get_full_folder_path(service, folder: gFolder)-> str:
                 
         
     except Exception as err:
-        logging.error("Error getting full local path for folder id %s. %s" % (folder.id, str(err)))
-        print(str(err))
+        if not retry.is_retryable(err):
+            logging.error("Error getting full local path for folder id %s. %s" % (folder.id, str(err)))
+        raise
 
     return full_path
 
-
-# download a single file (will be called multi-threaded)
-def download_file(service, file: gFile, targetPath:str, threadSafeDB:sqlite_store = None):
+# local path of the folder with this id, from the path resolver when it's loaded
+def get_folder_path_by_id(service, id:str) -> str:
+    if cfg.PATH_RESOLVER is not None:
+        try:
+            return cfg.PATH_RESOLVER.path_of(service, id)
+        except Exception as err:
+            if not retry.is_retryable(err):
+                logging.error("Error getting full local path for folder id %s. %s" % (id, str(err)))
+            raise
+    folder = get_drive_object(service, id)
+    if folder is None:
+        raise Exception("unable to fetch folder id %s from Google Drive" % id)
+    return get_full_folder_path(service, folder)
+
+
+# raised when a downloaded file doesn't match the md5Checksum reported by Drive
+class ChecksumMismatchError(Exception):
+    pass
+
+
+# tracks how far a download has got in the metadata db so that it can continue
+# from the same temp file after a restart, as long as the Drive version hasn't changed
+class DownloadProgress:
+    def __init__(self, db:sqlite_store, file:gFile, tempPath:str):
+        self.db = db
+        self.fileId = file.id
+        self.tempPath = tempPath
+        self.md5Checksum = file.properties.get('md5Checksum')
+        self.version = str(file.properties.get('version'))
+
+    # number of bytes already on disk that can be kept, 0 if the download has to start over
+    def resume_offset(self) -> int:
+        progress = self.db.fetch_download_progress(self.fileId)
+        if progress is None:
+            return 0
+        if progress['temp_path'] != self.tempPath or progress['md5_checksum'] != self.md5Checksum or \
+                progress['version'] != self.version or not os.path.exists(self.tempPath):
+            logging.debug("discarding stale download progress for file id %s." % self.fileId)
+            self.clear()
+            return 0
+        return min(progress['bytes_done'], os.path.getsize(self.tempPath))
+
+    def update(self, bytesDone:int):
+        self.db.update_download_progress(self.fileId, self.tempPath, bytesDone, self.md5Checksum, self.version)
+
+    def clear(self):
+        self.db.delete_download_progress(self.fileId)
+
+
+# stream a media request straight to disk. chunks go to a temp file next to the target
+# which is renamed into place once complete, so memory use is bounded by the chunk size.
+# the md5 is computed as the chunks are written and returned.
+def download_media_to_file(request, targetPath:str, expectedMd5:str = None, progress:DownloadProgress = None) -> str:
+    tempPath = targetPath + cfg.DOWNLOAD_TEMP_SUFFIX
+    try:
+        offset = progress.resume_offset() if progress is not None else 0
+        with open(tempPath, "r+b" if offset > 0 else "wb") as f:
+            writer = mods.HashingWriter(f)
+            if offset > 0:
+                logging.info("resuming download of '%s' at byte %d." % (targetPath, offset))
+                f.truncate(offset)
+                mods.hash_stream(f, writer.hash)
+            downloader = MediaIoBaseDownload(writer, request, chunksize=cfg.DOWNLOAD_CHUNK_SIZE)
+            # MediaIoBaseDownload has no public way to start mid-file. it builds the range
+            # header of the next chunk from _progress.
+            downloader._progress = offset
+            done = False
+            while done is False:
+                status, done = downloader.next_chunk()
+                if progress is not None and done is False:
+                    f.flush()
+                    progress.update(status.resumable_progress)
+            f.flush()
+            os.fsync(f.fileno())
+        md5 = writer.hexdigest()
+        if expectedMd5 is not None and md5 != expectedMd5:
+            raise ChecksumMismatchError("downloaded md5 %s doesn't match Drive md5 %s" % (md5, expectedMd5))
+        os.replace(tempPath, targetPath)
+        if progress is not None:
+            progress.clear()
+        return md5
+    except Exception as err:
+        # keep the partial file for resuming unless its content is known to be bad
+        if progress is None or isinstance(err, ChecksumMismatchError):
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            if progress is not None:
+                progress.clear()
+        raise
+
+
+# hashes the segments of a multi-part download in file order as they complete. md5 can't
+# be combined out of order, so finished segments are read back while still in the page cache
+class _SegmentHasher:
+    def __init__(self, fd, segments):
+        self.fd = fd
+        self.segments = segments
+        self.hash = hashlib.md5()
+        self.done = set()
+        self.next = 0
+
+    def segment_done(self, index:int):
+        self.done.add(index)
+        while self.next in self.done:
+            start, end = self.segments[self.next]
+            offset = start
+            while offset <= end:
+                data = os.pread(self.fd, min(cfg.DOWNLOAD_CHUNK_SIZE, end - offset + 1), offset)
+                if len(data) == 0:
+                    raise Exception("short read hashing segment at offset %d" % offset)
+                self.hash.update(data)
+                offset += len(data)
+            self.next += 1
+
+    # bytes from the start of the file that are downloaded and hashed
+    def bytes_hashed(self) -> int:
+        if self.next == 0:
+            return 0
+        return self.segments[self.next - 1][1] + 1
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+# fetch one byte range of a media uri on the worker's own connection and write it at its offset
+def _download_segment(uri:str, fd, start:int, end:int):
+    http = transport.get_http("media")
+    offset = start
+    while offset <= end:
+        chunkEnd = min(offset + cfg.DOWNLOAD_CHUNK_SIZE - 1, end)
+        resp, content = http.request(uri, "GET", headers={"range": "bytes=%d-%d" % (offset, chunkEnd)})
+        if resp.status != 206:
+            raise HttpError(resp, content, uri=uri)
+        if len(content) == 0:
+            raise Exception("empty range response at offset %d" % offset)
+        os.pwrite(fd, content, offset)
+        offset += len(content)
+
+
+# download a large media request as parallel range segments into a preallocated temp
+# file, then rename it into place. returns the md5 of the downloaded content.
+def download_media_to_file_multipart(request, targetPath:str, size:int, expectedMd5:str = None,
+                                        progress:DownloadProgress = None) -> str:
+    tempPath = targetPath + cfg.DOWNLOAD_TEMP_SUFFIX
+    segments = [(start, min(start + cfg.MULTIPART_SEGMENT_SIZE, size) - 1)
+                    for start in range(0, size, cfg.MULTIPART_SEGMENT_SIZE)]
+    offset = progress.resume_offset() if progress is not None else 0
+    logging.debug("downloading '%s' in %d segments." % (targetPath, len(segments)))
+    fd = None
+    try:
+        fd = os.open(tempPath, os.O_RDWR | os.O_CREAT | (0 if offset > 0 else os.O_TRUNC), 0o644)
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+        hasher = _SegmentHasher(fd, segments)
+        if offset > 0:
+            logging.info("resuming download of '%s' at byte %d." % (targetPath, offset))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=cfg.MULTIPART_DOWNLOAD_THREADS) as executor:
+            futures = {}
+            for i, (start, end) in enumerate(segments):
+                if end < offset:
+                    # already on disk from a previous run, only needs hashing
+                    hasher.segment_done(i)
+                else:
+                    futures[executor.submit(_download_segment, request.uri, fd, start, end)] = i
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    hasher.segment_done(futures[future])
+                    if progress is not None:
+                        progress.update(hasher.bytes_hashed())
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        md5 = hasher.hexdigest()
+        if expectedMd5 is not None and md5 != expectedMd5:
+            raise ChecksumMismatchError("downloaded md5 %s doesn't match Drive md5 %s" % (md5, expectedMd5))
+        os.replace(tempPath, targetPath)
+        if progress is not None:
+            progress.clear()
+        return md5
+    except Exception as err:
+        if fd is not None:
+            os.close(fd)
+        if progress is None or isinstance(err, ChecksumMismatchError):
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            if progress is not None:
+                progress.clear()
+        raise
+
+
+# download a single file (will be called multi-threaded). with raiseErrors, a failed download
+# is raised to the caller instead of logged, so a transfer scheduler counts it as failed
+def download_file(service, file: gFile, targetPath:str, threadSafeDB:sqlite_store = None, raiseErrors:bool = False):
     logging.debug("beginning to download file %s", file.name)
     sReturn = ""
     try:
@@ -200,9 +415,6 @@ def download_file(service, file: gFile, targetPath:str, threadSafeDB:sqlite_stor
                     "acknowledgeAbuse": True
         }
         request = gServiceFiles.get_media(**params)
-        fileData = io.BytesIO()
-        downloader = MediaIoBaseDownload(fileData, request)
-        done = False
         logging.info("downloading file %s." % targetPath)
         #print("downloading file %s." % targetPath)
 
@@ -211,35 +423,46 @@ def download_file(service, file: gFile, targetPath:str, threadSafeDB:sqlite_stor
             logging.debug("file's parent directory '%s' doesn't exist, creating." % fileDir)
             os.makedirs(os.path.expanduser(fileDir))
 
-        while done is False:
-            status, done = downloader.next_chunk()
-            #print(F'Download {int(status.progress() * 100)}.')
-
-        with open(targetPath, "wb+") as f:
-            f.write(fileData.getbuffer())
+        db = threadSafeDB if threadSafeDB is not None else cfg.DATABASE
+        progress = DownloadProgress(db, file, targetPath + cfg.DOWNLOAD_TEMP_SUFFIX)
+        expectedMd5 = file.properties.get('md5Checksum')
+        fileSize = int(file.properties.get('size', 0))
+        attempt = 1
+        while True:
+            try:
+                if fileSize >= cfg.MULTIPART_DOWNLOAD_THRESHOLD:
+                    file.md5 = download_media_to_file_multipart(request, targetPath, fileSize, expectedMd5, progress)
+                else:
+                    file.md5 = download_media_to_file(request, targetPath, expectedMd5, progress)
+                break
+            except ChecksumMismatchError as err:
+                if attempt >= cfg.DOWNLOAD_RETRIES_MAX:
+                    raise
+                logging.warning("%s. retrying download of '%s' (attempt %d)." % (str(err), targetPath, attempt))
+                attempt += 1
 
         file.localPath = targetPath
-        file.md5 = mods.hash_file(targetPath)
 
         # update the file timestamp to match what's in Drive
         mod_time = int(datetime.datetime.strptime(file.properties['modifiedTime'][:-5], '%Y-%m-%dT%H:%M:%S').strftime("%s"))
         os.utime(targetPath, (mod_time, mod_time))
 
 
-        if threadSafeDB is not None:
-            threadSafeDB.insert_gObject(file=file)
-        else:
-            cfg.DATABASE.insert_gObject(file=file)
+        db.insert_gObject(file=file)
 
         fileSize = os.path.getsize(targetPath)
         sReturn = "file %s written %d byes." % (targetPath, fileSize)
 
 
     except HttpError as err:
+        if raiseErrors or retry.is_retryable(err):
+            raise
         logging.error("error downloading file. %s" % str(err))
         print(err)
         sReturn = "file %s download failed with %s" % (targetPath, str(err))
     except Exception as err:
+        if raiseErrors or retry.is_retryable(err):
+            raise
         logging.error("error downloading file. %s" % str(err))
         print(err)
         sReturn = "file %s download failed with %s" % (targetPath, str(err))
@@ -264,15 +487,8 @@ def export_native_file(service, file: gFile, targetPath: str)-> bool:
                     "mimeType": targetMimeType
         }
         request = gServiceFiles.export_media(**params)
-        fileData = io.BytesIO()
-        downloader = MediaIoBaseDownload(fileData, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            print(F'Download {int(status.progress() * 100)}.')
-
-        with open(targetPath, "wb+") as f:
-            f.write(fileData.getbuffer())
+        download_media_to_file(request, targetPath)
+        bSuccess = True
 
     except HttpError as err:
         logging.error("error exporting google application file. %s", str(err))
@@ -308,50 +524,49 @@ def list_files_in_dir(service, folder:gFolder, maxFiles = 1000) -> List[gFile]:
     return files
 
 
-# download all files in a folder (non-recursive)
-def download_files_from_folder(service, folder: gFolder, targetDir: str) -> bool:
+# queue downloads of all files in a folder (non-recursive). without a scheduler the
+# files are downloaded by a private one and the call waits for them to finish
+def download_files_from_folder(service, folder: gFolder, targetDir: str,
+                                scheduler = None) -> bool:
     logging.debug("starting to download files from %s to %s" % (folder.name, targetDir))
     bResult = False
+    ownScheduler = scheduler is None
     try:
+        if ownScheduler:
+            scheduler = transfers.TransferScheduler()
+            scheduler.start()
+
         files = list_files_in_dir(service, folder)
 
-        # the google api module isn't thread safe, since it's based on http2 which also isn't thread safe
-        # https://googleapis.github.io/google-api-python-client/docs/thread_safety.html
-        with concurrent.futures.ThreadPoolExecutor(max_workers=cfg.MAX_THREADS) as executor:
-            futures = []
-            for f in files:
-                if not "application/vnd.google-apps" in f.properties['mimeType']:
-                    filePath = os.path.join(targetDir, folder.name, f.name)
-
-                    # build a new http2 object to enable thread safety.  gets passed to each thread   
-                    credentials = Credentials.from_authorized_user_file(cfg.TOKEN_CACHE, cfg.TARGET_SCOPES)
-                    authorized_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
-                    service = discovery.build('drive', 'v3', requestBuilder=build_request, http=authorized_http)
-
-                    # build new database object for multi-threading too
-                    threadSafeDB = sqlite_store()
-                    threadSafeDB.open(cfg.DATABASE_PATH)
-                    
-                    futures.append(executor.submit(
-                            download_file, service, f, filePath, threadSafeDB
-                        ))
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                logging.debug("Download result: %s" % str(result))
-            #wait(futures) # want to make sure we don't start too many threads
+        for f in files:
+            if not "application/vnd.google-apps" in f.properties['mimeType']:
+                filePath = os.path.join(targetDir, folder.name, f.name)
+                scheduler.submit(_download_file_task, f, filePath, size=transfers.remote_item_size(f))
+        bResult = True
+
+        if ownScheduler:
+            scheduler.join()
     except Exception as err:
         logging.error("error downloading directory %s. %s." % (folder.name, str(err)))
         bResult = False
+    finally:
+        if ownScheduler and scheduler is not None:
+            scheduler.stop()
     return bResult
 
 
+# runs on a transfer worker thread, with that thread's pooled service and db connection
+def _download_file_task(file: gFile, filePath: str):
+    return download_file(pool.get_service(), file, filePath, pool.get_database(), raiseErrors=True)
+
+
 def write_folder_cache(service, localCachePath:str = cfg.FOLDERS_CACHE_PATH):
     logging.debug("writing local folder cache to %s." % str(localCachePath))
     try:
         # get the root folder
         gServiceFiles = service.files()
         if not cfg.ROOT_FOLDER_OBJECT:
-            request = gServiceFiles.get(fileId = 'root')
+            request = gServiceFiles.get(fileId = 'root', fields = cfg.OBJECT_FIELDS)
             rootFolder = request.execute()
 
         else:
@@ -374,41 +589,172 @@ def write_folder_cache(service, localCachePath:str = cfg.FOLDERS_CACHE_PATH):
         }
         request = gServiceFiles.list(**params)
 
+        # list every folder first, so their paths come from the listing instead of
+        # a walk up the parents of each one
+        folders = []
         while request is not None:
             files_page = request.execute()
             fs = files_page.get('files', [])
             for f in fs:
-                #print(f)
-                with open(cfg.FOLDERS_CACHE_PATH + f['id'], 'w+') as folder_data:
-                    folderObj = gFolder(f)
-                    folderObj.localPath = os.path.join(cfg.DRIVE_CACHE_PATH, get_full_folder_path(service, folderObj))
-                    cfg.DATABASE.insert_gObject(folder=folderObj)
-                    if 'parents' in folderObj.properties.keys():
-                        cfg.DATABASE.insert_parents(folderObj.id, folderObj.properties['parents'])
-                    folder_data.write(json.dumps(f, indent=5))
-                    folder_data.close()
+                folderObj = gFolder(f)
+                if cfg.NAMESPACE is not None:
+                    cfg.NAMESPACE.upsert_remote(folderObj.id, folderObj.name, folderObj.mimeType, \
+                                                folderObj.properties.get('parents', []), folderObj.properties.get('ownedByMe'))
+                folders.append(folderObj)
         
             request = gServiceFiles.list_next(request, files_page)
 
+        for folderObj in folders:
+            # a folder whose path can't be resolved is left out, the startup scan picks it up
+            try:
+                folderPath = get_full_folder_path(service, folderObj)
+            except Exception as err:
+                logging.warning("skipping folder id %s in the folder cache. %s" % (folderObj.id, str(err)))
+                continue
+            with open(cfg.FOLDERS_CACHE_PATH + folderObj.id, 'w+') as folder_data:
+                folderObj.localPath = os.path.join(cfg.DRIVE_CACHE_PATH, folderPath)
+                cfg.DATABASE.insert_gObject(folder=folderObj)
+                if 'parents' in folderObj.properties.keys():
+                    cfg.DATABASE.insert_parents(folderObj.id, folderObj.properties['parents'])
+                folder_data.write(json.dumps(folderObj.properties, indent=5))
+                folder_data.close()
+
 
     except HttpError as err:
         logging.error("error writing local folder cache. %s", str(err))
         print(err)
 
 
-# full sync down
+# full sync down. walks the folder tree and feeds every file into one global transfer
+# queue, so a folder with one huge file doesn't hold up the rest of the tree
 def do_full_download(service, folder: gFolder, targetPath:str):
     logging.debug("starting full download from google drive to %s" % targetPath)
     try:
-        download_files_from_folder(service, folder, os.path.join(targetPath))
-        if folder.children is not None:
-            for child in folder.children:
-                do_full_download(service, child, os.path.join(targetPath, folder.name))
-        
+        cfg.TRANSFER_SCHEDULER = transfers.TransferScheduler()
+        cfg.TRANSFER_SCHEDULER.start()
+        _queue_folder_downloads(service, folder, targetPath, cfg.TRANSFER_SCHEDULER)
+        cfg.TRANSFER_SCHEDULER.join()
+        s = cfg.TRANSFER_SCHEDULER.stats()
+        logging.info("full download finished. %d files downloaded, %d failed." % (s['completed'], s['failed']))
+
     except Exception as err:
-        logging.error("error writing local folder cache. %s" % str(err))
+        logging.error("error doing the full download. %s" % str(err))
         print(str(err))
-    
+    finally:
+        if cfg.TRANSFER_SCHEDULER is not None:
+            cfg.TRANSFER_SCHEDULER.stop()
+
+def _queue_folder_downloads(service, folder: gFolder, targetPath:str, scheduler):
+    download_files_from_folder(service, folder, os.path.join(targetPath), scheduler)
+    if folder.children is not None:
+        for child in folder.children:
+            _queue_folder_downloads(service, child, os.path.join(targetPath, folder.name), scheduler)
+
+
+# first sync from one flat listing of the whole drive, instead of a files.list per folder.
+# the snapshot is bulk loaded into the metadata db, local paths come from the tree built in
+# memory, and transfers only start once everything is loaded. the changes token is taken
+# before the listing and stored once every file of the snapshot is on disk, so startup catches
+# up from it instead of scanning the drive again. if any download failed no token is stored
+# and the full scan that follows fetches the missing files. returns True if the token was stored
+def do_bootstrap_download(service, targetPath:str) -> bool:
+    logging.info("bootstrapping the local copy from a snapshot of google drive.")
+    stored = False
+    try:
+        startToken = get_drive_changes_token(service)
+        objects = list_drive_snapshot(service)
+        folders, files = build_snapshot_tree(objects, targetPath)
+        logging.info("snapshot has %d folders and %d files under the root folder." % (len(folders), len(files)))
+
+        snapshot = folders + files
+        for i in range(0, len(snapshot), cfg.BOOTSTRAP_INSERT_SIZE):
+            cfg.DATABASE.bulk_insert_gObjects(snapshot[i:i + cfg.BOOTSTRAP_INSERT_SIZE])
+
+        cfg.TRANSFER_SCHEDULER = transfers.TransferScheduler()
+        cfg.TRANSFER_SCHEDULER.start()
+        for f in files:
+            cfg.TRANSFER_SCHEDULER.submit(_bootstrap_download_task, f, f.localPath, size=transfers.remote_item_size(f))
+        cfg.TRANSFER_SCHEDULER.join()
+        s = cfg.TRANSFER_SCHEDULER.stats()
+        logging.info("bootstrap download finished. %d files downloaded, %d failed." % (s['completed'], s['failed']))
+
+        if startToken is None:
+            logging.warning("no changes token was taken before the snapshot, a full scan will follow.")
+        elif s['failed'] > 0:
+            logging.warning("%d bootstrap downloads failed, a full scan will follow." % s['failed'])
+        else:
+            cfg.DATABASE.update_sync_state('changes_token', startToken)
+            stored = True
+
+    except Exception as err:
+        logging.error("error bootstrapping from a drive snapshot. %s" % str(err))
+        print(str(err))
+    finally:
+        if cfg.TRANSFER_SCHEDULER is not None:
+            cfg.TRANSFER_SCHEDULER.stop()
+    return stored
+
+# every object in the drive that isn't trashed, in pages as large as the API allows
+def list_drive_snapshot(service) -> List:
+    objects = []
+    gServiceFiles = service.files()
+    params = { "q": "trashed = false",
+                "pageSize": cfg.BOOTSTRAP_PAGE_SIZE,
+                "fields": "nextPageToken, files(" + cfg.BOOTSTRAP_FIELDS + ")"
+    }
+    request = gServiceFiles.list(**params)
+    pages = 0
+    while request is not None:
+        files_page = request.execute()
+        for f in files_page.get('files', []):
+            if f['mimeType'] == cfg.TYPE_GOOGLE_FOLDER:
+                objects.append(gFolder(f))
+            else:
+                objects.append(gFile(f))
+        pages += 1
+        if pages % 50 == 0:
+            logging.info("listed %d objects from google drive." % len(objects))
+        request = gServiceFiles.list_next(request, files_page)
+    return objects
+
+# walk the snapshot down from the root folder and set local paths. returns the owned
+# folders and the downloadable files that are reachable from the root, like the walk
+# that do_full_download does over the API
+def build_snapshot_tree(objects: List, targetPath:str) -> tuple:
+    children = {}
+    for o in objects:
+        parents = o.properties.get('parents', [])
+        if len(parents) > 0:
+            children.setdefault(parents[0], []).append(o)
+
+    folders = []
+    files = []
+    rootPath = os.path.join(targetPath, cfg.ROOT_FOLDER_OBJECT.name)
+    pending = [(cfg.ROOT_FOLDER_ID, rootPath)]
+    while len(pending) > 0:
+        id, path = pending.pop()
+        for o in children.get(id, []):
+            o.localPath = os.path.join(path, o.name)
+            if o.mimeType == cfg.TYPE_GOOGLE_FOLDER:
+                if o.properties.get('ownedByMe', True) == False:
+                    continue
+                folders.append(o)
+                pending.append((o.id, o.localPath))
+            elif cfg.TYPE_GOOGLE_APPS not in o.mimeType:
+                o.md5 = None
+                files.append(o)
+    return folders, files
+
+# a file that didn't make it to disk is dropped from the db again. the failure keeps the
+# bootstrap from storing a changes token, so the full scan that follows picks it up as new
+def _bootstrap_download_task(file: gFile, filePath: str):
+    db = pool.get_database()
+    try:
+        return download_file(pool.get_service(), file, filePath, db, raiseErrors=True)
+    finally:
+        if not os.path.exists(filePath):
+            db.delete_gObject(file.id)
+
 
 # retrieve the metadata for Google object (file or folder)
 def get_drive_object(service, id:str):
@@ -416,7 +762,7 @@ def get_drive_object(service, id:str):
     try:
         gServiceFiles = service.files()
         params = { "fileId": id,
-                    "fields": "*"
+                    "fields": cfg.CHANGE_FIELDS
         }
         request = gServiceFiles.get(**params)
         object = request.execute()
@@ -449,14 +795,18 @@ def create_drive_folder(service, folderName:str, localPath:str, parentId:str=Non
         }
 
         logging.info("creating folder %s in Google Drive" % folderName)
-        f = service.files().create(body=file_metadata, fields='*').execute()
+        f = service.files().create(body=file_metadata, fields=cfg.UPLOAD_FIELDS).execute()
         folder = gFolder(f)
         folder.localPath = localPath
         cfg.DATABASE.insert_gObject(folder=folder)
 
     except HttpError as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error creating Google Drive folder. %s" % str(err))
     except Exception as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error creating Google Drive folder. %s" % str(err))
 
     return folder
@@ -474,8 +824,7 @@ def create_drive_folder_tree(service, folderPath:str) -> gFolder:
         currentFolder = cfg.ROOT_FOLDER_OBJECT.localPath
         for folder in folders:
             currentFolder = os.path.join(currentFolder, folder)
-            c, dbFolders = cfg.DATABASE.fetch_gObjectSet(searchField="local_path", \
-                            searchCriteria=currentFolder)
+            dbFolders = cfg.DATABASE.fetch_gObjects_by_path(currentFolder)
             if len(dbFolders) == 0:
                 parent = create_drive_folder(service, folder, currentFolder, parent.id)
             else:
@@ -519,8 +868,12 @@ def upload_drive_file(service, filePath:str, parentId:str = None)-> gFile:
         if attempt == cfg.UPLOAD_RETRIES_MAX:
             logging.error("Exceeded max retries to upload file '%s'" % filePath)
     except HttpError as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error uploading file to Google Drive. %s" % str(err))
     except Exception as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error uploading file to Google Drive. %s" % str(err))
     return file
 
@@ -535,10 +888,14 @@ def upload_drive_file_simple(service, filePath:str, parentId:str=None)->gFile:
         file_metadata = {'name': fileName, 'parents': parentId}
         media = MediaFileUpload(filePath, resumable=True)
         file = service.files().create(body=file_metadata, media_body=media,
-                                      fields='*').execute()
+                                      fields=cfg.UPLOAD_FIELDS).execute()
     except HttpError as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error downing a simple file upload to Google Drive. %s" % str(err))
     except Exception as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error downing a simple file upload to Google Drive. %s" % str(err))
     return file
 
@@ -556,8 +913,7 @@ def upload_new_local_files(service):
                         return
                     else:
                         parentFolder = os.path.dirname(f.localPath)
-                        c, db_parentFolders = cfg.DATABASE.fetch_gObjectSet(searchField = "local_path", \
-                                                    searchCriteria=parentFolder)
+                        db_parentFolders = cfg.DATABASE.fetch_gObjects_by_path(parentFolder)
                         db_parentFolder = db_parentFolders[0]
                         if db_parentFolder is not None:
                             f.properties['parents'] = [db_parentFolder.id]
@@ -584,7 +940,8 @@ def update_drive_file(service, file:gFile, localPath:str):
         updated_file = service.files().update(
             fileId=file.id,
             #body=file.properties,
-            media_body=media_body).execute()
+            media_body=media_body,
+            fields="id").execute()
         # get the encriched full metadata
         updated_file = get_drive_object(service, updated_file['id'])
         updated_file.localPath = file.localPath
@@ -593,8 +950,12 @@ def update_drive_file(service, file:gFile, localPath:str):
         cfg.DATABASE.update_gObject(file=updated_file)
 
     except HttpError as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error updating Google drive file '%s'. %s" % (file.name, str(err)))
     except Exception as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error updating Google drive file '%s'. %s" % (file.name, str(err)))
     return updated_file 
 
@@ -639,13 +1000,17 @@ def move_drive_file(service, file:gFile, newParent_id: str=None, newName:str = N
             logging.info("moved file ID '%s' to new parent ID '%s'" % (file.id, newParent_id))
         else:
             if file.name != newName:
-                file = service.files().update(fileId=file.id, body={'name': newName}).execute()
+                file = service.files().update(fileId=file.id, body={'name': newName}, fields='id').execute()
                 file = get_drive_object(service, file['id'])
             else:
                 logging.warning("Unable to process file '%s' move.  Can't parse the change." % file.id)
     except HttpError as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error moving file '%s' in Google Drive. %s" % (file.name, str(err)))
     except Exception as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error moving file '%s' in Google Drive. %s" % (file.name, str(err)))
     return file   
 
@@ -660,6 +1025,8 @@ def delete_drive_file(service, file:gFile):
         cfg.DATABASE.delete_gObject(id=file.id) # do we want to delete the file?  or just mark it as trashed?
 
     except HttpError as err:
+        if retry.is_retryable(err):
+            raise
         # 404, delete from db since it's gone from Drive
         if err.resp.status == 404:
             logging.info("File not found in Drive, removing from db.")
@@ -667,6 +1034,8 @@ def delete_drive_file(service, file:gFile):
         else:
             logging.error("error deleteing file '%s' from Google Drive. %s" % (file.name, str(err)))
     except Exception as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error deleteing file '%s' from Google Drive. %s" % (file.name, str(err)))
     return file    
 
@@ -689,14 +1058,18 @@ def get_drive_changes_token(service):
     
     return startToken
 
-# get changes since the last change token fetch
+# get changes since the last change token fetch. with raiseErrors, a rejected token
+# is raised to the caller instead of logged
 # https://developers.google.com/drive/api/guides/manage-changes
-def get_drive_changes(service, changeToken):
+def get_drive_changes(service, changeToken, raiseErrors:bool = False):
     changes = []
     try:
         while changeToken is not None:
             response = service.changes().list(pageToken=changeToken,
-                                              spaces='drive').execute()
+                                              spaces='drive',
+                                              includeRemoved=True,
+                                              pageSize=cfg.CHANGES_PAGE_SIZE,
+                                              fields=cfg.CHANGES_LIST_FIELDS).execute()
             for change in response.get('changes'):
                 # Process change
                 changes.append(change)
@@ -706,14 +1079,130 @@ def get_drive_changes(service, changeToken):
                 cfg.CHANGES_TOKEN = response.get('newStartPageToken')
             changeToken = response.get('nextPageToken')
     except HttpError as err:
+        if raiseErrors:
+            raise
         logging.error("error getting changes from Drive. %s", str(err))
         print(err)
     except Exception as err:
+        if raiseErrors:
+            raise
         logging.error("error getting changes from Drive. %s", str(err))
         print(str(err))   
 
     return changes
 
+# journal a set of changes together with the token that follows them, then queue them for
+# the remote workers. changes to objects we just changed ourselves are dropped. returns False
+# if the journal can't be written, in which case nothing is queued and the caller polls the
+# same changes again from the token before them
+def queue_drive_changes(service, changes: List[dict], token:str) -> bool:
+    pending = []
+    ignored = []
+    ignores = list(cfg.RQUEUE_IGNORE)
+    for change in changes:
+        if change['fileId'] in ignores:
+            ignores.remove(change['fileId'])
+            ignored.append(change['fileId'])
+        else:
+            pending.append(change)
+    journalIds = cfg.DATABASE.journal_changes(pending, token)
+    if journalIds is None:
+        logging.warning("unable to journal %d google drive changes, they'll be fetched again." % len(pending))
+        return False
+    for id in ignored:
+        if id in cfg.RQUEUE_IGNORE:
+            cfg.RQUEUE_IGNORE.remove(id)
+    latest = {}
+    for change in pending:
+        latest[change['fileId']] = (journalIds[change['fileId']], change)
+    queue_journaled_changes(service, latest)
+    return True
+
+# build the object a change applies to from the file resource embedded in it. removed
+# entries carry no file, so they become a trashed, one version newer copy of what's in
+# the db. returns None when the change has nothing to apply locally
+def drive_object_from_change(change: dict):
+    if change.get('removed', False):
+        dbObjects = cfg.DATABASE.fetch_gObject(change['fileId'])
+        if len(dbObjects) == 0:
+            return None
+        gObject = dbObjects[0]
+        gObject.properties = dict(gObject.properties)
+        gObject.properties['trashed'] = True
+        gObject.properties['version'] = str(int(gObject.properties.get('version', 0)) + 1)
+        return gObject
+    f = change.get('file')
+    if f is None:
+        return None
+    if f['mimeType'] == cfg.TYPE_GOOGLE_FOLDER:
+        return gFolder(f)
+    return gFile(f)
+
+# queue journaled changes, file id -> (journal id, change). each queued object carries the
+# journal id that its worker clears once the change is applied. only changes without an
+# embedded file, e.g. from an older journal, are fetched, and those in batches
+def queue_journaled_changes(service, journal: dict):
+    gObjects = {}
+    fetchIds = []
+    for id, (journalId, change) in journal.items():
+        gObject = drive_object_from_change(change)
+        if gObject is not None:
+            gObjects[id] = gObject
+        elif not change.get('removed', False):
+            fetchIds.append(id)
+    if len(fetchIds) > 0:
+        gObjects.update(batch.batch_get_drive_objects(service, fetchIds))
+
+    planned = []
+    for id, (journalId, change) in journal.items():
+        if id not in gObjects:
+            # nothing to apply, the object isn't known locally or can't be fetched any more
+            if journalId is not None:
+                cfg.DATABASE.delete_journal_entries(id, journalId)
+            continue
+        gObject = gObjects[id]
+        gObject.journalId = journalId
+        planned.append(gObject)
+    planner.queue_changes(planned)
+
+# queue the changes that were journaled but not applied before the last shutdown
+def replay_change_journal(service) -> int:
+    journal = cfg.DATABASE.fetch_change_journal()
+    if len(journal) > 0:
+        logging.info("replaying %d journaled changes from the last run." % len(journal))
+        queue_journaled_changes(service, journal)
+    return len(journal)
+
+# catch up from a stored changes token instead of scanning the whole drive. returns False
+# when Drive rejects the token and a full scan is needed. rate limits, server errors and
+# dropped connections are retried with backoff, anything else is raised
+def catch_up_drive_changes(service, changeToken:str) -> bool:
+    logging.info("catching up on google drive changes from the stored changes token.")
+    attempt = 0
+    while True:
+        try:
+            cfg.CHANGES_TOKEN = changeToken
+            changes = get_drive_changes(service, changeToken, raiseErrors=True)
+            break
+        except Exception as err:
+            if isinstance(err, HttpError) and err.resp.status in cfg.CHANGES_TOKEN_REJECTED_STATUS:
+                logging.warning("stored changes token was rejected, falling back to a full scan. %s" % str(err))
+                return False
+            attempt += 1
+            if not retry.is_retryable(err) or attempt >= cfg.RETRY_MAX_ATTEMPTS:
+                logging.error("unable to catch up on google drive changes. %s" % str(err))
+                raise
+            delay = retry.backoff_delay(attempt, err)
+            logging.warning("catching up on google drive changes failed on attempt %d, retrying in %.1f seconds. %s" % \
+                                (attempt, delay, str(err)))
+            sleep(delay)
+    if not queue_drive_changes(service, changes, cfg.CHANGES_TOKEN):
+        # the polling loop fetches them again from the stored token
+        cfg.CHANGES_TOKEN = changeToken
+        return True
+    logging.info("caught up on %d google drive changes." % len(changes))
+    return True
+
 # handles any sort of change in a file in google drive (create, update, delete)
 def handle_changed_file(service, file:gFile = None):
     try:
@@ -731,17 +1220,19 @@ def handle_changed_file(service, file:gFile = None):
                 logging.debug("file id %s isn't in the database, assuming a new object." % file.id)
                 if 'parents' in file.properties.keys():
                     for parent_id in file.properties['parents']:
-                        parent_folder = get_drive_object(service, parent_id)
                         full_path = os.path.join(cfg.DRIVE_CACHE_PATH, \
-                            get_full_folder_path(service, parent_folder), \
+                            get_folder_path_by_id(service, parent_id), \
                             file.name)
                         full_path = os.path.expanduser(full_path)
                         file.localPath = full_path
-                        cfg.DATABASE.insert_gObject(file=file)
     
                         if file.properties['trashed'] == False:
+                            # download_file records the file once it's on disk, so a retried
+                            # change still finds it missing from the db
                             cfg.LQUEUE_IGNORE.append(full_path)
                             download_file(service, file, full_path)
+                        else:
+                            cfg.DATABASE.insert_gObject(file=file)
                     
             else:
                 # **** handle file updates ****
@@ -758,15 +1249,13 @@ def handle_changed_file(service, file:gFile = None):
                                 if 'parents' in file.properties.keys():
                                     for parent_id in file.properties['parents']:
                                         for db_parent_id in dbFile.properties['parents']:
-                                            parent_folder = get_drive_object(service, parent_id)
                                             root_path = os.path.join(cfg.DRIVE_CACHE_PATH, \
-                                                get_full_folder_path(service, parent_folder))
+                                                get_folder_path_by_id(service, parent_id))
                                             full_path = os.path.join(root_path, file.name)
                                             full_path = os.path.expanduser(full_path)
 
-                                            parent_folder = get_drive_object(service, db_parent_id)
                                             root_path_old = os.path.join(cfg.DRIVE_CACHE_PATH, \
-                                                get_full_folder_path(service, parent_folder))
+                                                get_folder_path_by_id(service, db_parent_id))
                                             full_path_old = os.path.join(root_path_old, dbFile.name)
                                             full_path_old = os.path.expanduser(full_path_old)
 
@@ -795,6 +1284,8 @@ def handle_changed_file(service, file:gFile = None):
                                                         #cfg.LQUEUE_IGNORE.remove(full_path)
 
                             except Exception as err:
+                                if retry.is_retryable(err):
+                                    raise
                                 logging.error("unable to update file id %s. %s" % (file.id, str(err)))
                         else:
                             file.md5 = dbFile.md5
@@ -808,9 +1299,8 @@ def handle_changed_file(service, file:gFile = None):
                         if 'parents' in file.properties.keys():
                             for parent_id in file.properties['parents']:
                                 try:
-                                    parent_folder = get_drive_object(service, parent_id)
                                     full_path = os.path.join(cfg.DRIVE_CACHE_PATH, \
-                                        get_full_folder_path(service, parent_folder), \
+                                        get_folder_path_by_id(service, parent_id), \
                                         file.name)
                                     full_path = os.path.expanduser(full_path)
                                     if os.path.exists(full_path):
@@ -820,11 +1310,17 @@ def handle_changed_file(service, file:gFile = None):
                                         #sleep(0.2) # give the Watchdog service time to catch up
                                         #cfg.LQUEUE_IGNORE.remove(full_path)
                                 except Exception as err:
+                                    if retry.is_retryable(err):
+                                        raise
                                     logging.error("unable to remove local file %s. %s" % (full_path, str(err)))
 
     except Exception as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error processing Google object change. %s" % str(err))
     except HttpError as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error processing Google object change. %s" % str(err))
     return 
 
@@ -847,9 +1343,8 @@ def handle_changed_folder(service, folder: gFolder = None):
                 cfg.DATABASE.insert_gObject(folder=folder)
                 if 'parents' in folder.properties.keys():
                     for parent_id in folder.properties['parents']:
-                        parent_folder = get_drive_object(service, parent_id)
                         full_path = os.path.join(cfg.DRIVE_CACHE_PATH, \
-                            get_full_folder_path(service, parent_folder), \
+                            get_folder_path_by_id(service, parent_id), \
                             folder.name)
                         full_path = os.path.expanduser(full_path)
                         if not os.path.exists(full_path):
@@ -869,15 +1364,13 @@ def handle_changed_folder(service, folder: gFolder = None):
                     if folder.name != dbFolder.name and folder.properties['trashed'] == False:
                         for parent_id in folder.properties['parents']:
                             for db_parent_id in dbFolder.properties['parents']:
-                                parent_folder = get_drive_object(service, parent_id)
                                 root_path_new = os.path.join(cfg.DRIVE_CACHE_PATH, \
-                                    get_full_folder_path(service, parent_folder))
+                                    get_folder_path_by_id(service, parent_id))
                                 full_path_new = os.path.join(root_path_new, folder.name)
                                 full_path_new = os.path.expanduser(full_path_new)
 
-                                parent_folder = get_drive_object(service, db_parent_id)
                                 root_path_old = os.path.join(cfg.DRIVE_CACHE_PATH, \
-                                    get_full_folder_path(service, parent_folder))
+                                    get_folder_path_by_id(service, db_parent_id))
                                 full_path_old = os.path.join(root_path_old, dbFolder.name)
                                 full_path_old = os.path.expanduser(full_path_old)
 
@@ -890,9 +1383,8 @@ def handle_changed_folder(service, folder: gFolder = None):
                     if folder.properties['trashed'] == True:
                         if 'parents' in folder.properties.keys():
                             for parent_id in folder.properties['parents']:
-                                parent_folder = get_drive_object(service, parent_id)
                                 full_path = os.path.join(cfg.DRIVE_CACHE_PATH, \
-                                    get_full_folder_path(service, parent_folder), \
+                                    get_folder_path_by_id(service, parent_id), \
                                     folder.name)
                                 full_path = os.path.expanduser(full_path)
                                 if os.path.exists(full_path):
@@ -901,8 +1393,12 @@ def handle_changed_folder(service, folder: gFolder = None):
                                     shutil.rmtree(full_path)
                             
     except Exception as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error processing Google object change. %s" % str(err))
     except HttpError as err:
+        if retry.is_retryable(err):
+            raise
         logging.error("error processing Google object change. %s" % str(err))
     return
 
@@ -923,59 +1419,46 @@ def get_gdrive_changes(service) -> List:
         gServiceFiles = service.files()
         params = { "q": "'me' in owners",
                     "pageSize": cfg.PAGE_SIZE, 
-                    "fields": "nextPageToken," + "files(id, name, mimeType, version, md5Checksum, parents, ownedByMe)"
+                    "fields": "nextPageToken, files(" + cfg.SCAN_FIELDS + ")"
         }
         request = gServiceFiles.list(**params)
 
         while (request is not None):
             files_page = request.execute()
             fs = files_page.get('files', [])
+            # ids whose full metadata we need, fetched in batches once the page is sorted
+            fetchIds = []
+            knownIds = set()
             for f in fs:
                 dbFile = None
                 rows = cfg.DATABASE.fetch_gObject(f['id'])
                 if len(rows) > 0:
                     dbFile = rows[0]
-                if f['mimeType'] == cfg.TYPE_GOOGLE_FOLDER:
-                    googleFolder = gFolder(f)
-                    if dbFile is not None and 'version' in dbFile.properties.keys():
-                        # if (dbFile.id != googleFolder.id or \
-                        #            dbFile.name != googleFolder.name) and \
-                        #            dbFile.properties['version'] < googleFolder.properties['version']:
-                        if (int(dbFile.properties['version']) < int(googleFolder.properties['version'])):
-                            # fetch full metadata of the file
-                            get_params = {"fileId": googleFolder.id, "fields": "*"}
-                            get_req = gServiceFiles.get(**get_params)
-                            full_folder = gFolder(get_req.execute())
-                            full_folder.localPath = get_full_folder_path(service, full_folder)
-                            #differences.append(full_folder)
-                            cfg.REMOTE_QUEUE.put(full_folder)
-                    else:
-                        get_params = {"fileId": googleFolder.id, "fields": "*"}
-                        get_req = gServiceFiles.get(**get_params)
-                        full_folder = gFolder(get_req.execute())
-                        #differences.append(full_folder)
-                        cfg.REMOTE_QUEUE.put(full_folder)
-                    
-                else:
-                    googleFile = gFile(f)
-                    if dbFile is not None and 'version' in dbFile.properties.keys():
-                        #if (dbFile.md5 != googleFile.properties['md5Checksum'] or \
-                        #    dbFile.mimeType != googleFile.mimeType) and \
-                        #    dbFile.properties['version'] < googleFile.properties['version']:
-                        if (int(dbFile.properties['version']) < int(googleFile.properties['version'])):
-                                # fetch full metadata of the file
-                                get_params = {"fileId": googleFile.id, "fields": "*"}
-                                get_req = gServiceFiles.get(**get_params)
-                                full_file = gFile(get_req.execute())
-                                #differences.append(full_file)
-                                cfg.REMOTE_QUEUE.put(full_file)
-                    else:
-                        if cfg.TYPE_GOOGLE_APPS not in googleFile.mimeType:
-                            get_params = {"fileId": googleFile.id, "fields": "*"}
-                            get_req = gServiceFiles.get(**get_params)
-                            full_file = gFile(get_req.execute())
-                            #differences.append(full_file)
-                            cfg.REMOTE_QUEUE.put(full_file)
+                    knownIds.add(f['id'])
+                if dbFile is not None and 'version' in dbFile.properties.keys():
+                    # if (dbFile.id != googleFolder.id or \
+                    #            dbFile.name != googleFolder.name) and \
+                    #            dbFile.properties['version'] < googleFolder.properties['version']:
+                    if (int(dbFile.properties['version']) < int(f['version'])):
+                        fetchIds.append(f['id'])
+                elif f['mimeType'] == cfg.TYPE_GOOGLE_FOLDER or cfg.TYPE_GOOGLE_APPS not in f['mimeType']:
+                    fetchIds.append(f['id'])
+
+            fullObjects = batch.batch_get_drive_objects(service, fetchIds, cfg.CHANGE_FIELDS)
+            planned = []
+            for id in fetchIds:
+                if id not in fullObjects:
+                    continue
+                fullObject = fullObjects[id]
+                if fullObject.mimeType == cfg.TYPE_GOOGLE_FOLDER and id in knownIds:
+                    # the worker resolves the path again, and retries, if it can't be done here
+                    try:
+                        fullObject.localPath = get_full_folder_path(service, fullObject)
+                    except Exception as err:
+                        logging.debug("path of folder id %s left to the change handler. %s" % (id, str(err)))
+                #differences.append(fullObject)
+                planned.append(fullObject)
+            planner.queue_changes(planned)
             request = gServiceFiles.list_next(request, files_page)
     except HttpError as err:
         #exc_type, exc_obj, exc_tb = sys.exc_info()
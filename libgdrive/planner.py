@@ -0,0 +1,164 @@
+# dependency-aware planning of remote change batches
+# the objects of a batch of Drive changes are linked into a small dependency graph before
+# they go to the remote queue: a change waits for the change of the nearest folder above it
+# that's created, renamed or moved in the same batch, a trashed folder waits for the objects
+# moving out of it, and the trashed objects below a trashed folder are folded into that
+# folder's change. whatever doesn't wait on anything is queued straight away, the rest is
+# queued by the workers as the changes it waits for finish.
+
+import logging
+import os
+import sys
+import threading
+from typing import List
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from config import config as cfg
+
+
+_lock = threading.Lock()
+
+
+def _is_trashed(gObject) -> bool:
+    return gObject.properties.get('trashed', False) == True
+
+def _is_folder(gObject) -> bool:
+    return gObject.mimeType == cfg.TYPE_GOOGLE_FOLDER
+
+# first parent of an object, from the batch if the object is in it, else from the index
+def _parent_of(id:str, batch:dict) -> str:
+    gObject = batch.get(id)
+    if gObject is not None:
+        parents = gObject.properties.get('parents', [])
+    elif cfg.NAMESPACE is not None:
+        node = cfg.NAMESPACE.node(id)
+        parents = node[3] if node is not None else ()
+    else:
+        parents = ()
+    return parents[0] if len(parents) > 0 else None
+
+# ids of the folders above an object, nearest first
+def _ancestors(id:str, batch:dict) -> List[str]:
+    ancestors = []
+    seen = set([id])
+    current = _parent_of(id, batch)
+    while current is not None and current not in seen:
+        ancestors.append(current)
+        seen.add(current)
+        current = _parent_of(current, batch)
+    return ancestors
+
+# local path an object is at before the batch is applied
+def _current_path(id:str) -> str:
+    if cfg.NAMESPACE is None:
+        return None
+    node = cfg.NAMESPACE.node(id)
+    return node[2] if node is not None and node[2] else None
+
+def _wait_for(gObject, dependency):
+    dependency.dependents.append(gObject)
+    gObject.waitingOn += 1
+
+
+# link a batch of changed objects. returns the objects that can be queued now, trashes
+# first, then folders, then files
+def plan_changes(gObjects: List) -> List:
+    batch = {}
+    for gObject in gObjects:
+        batch[gObject.id] = gObject
+    for gObject in batch.values():
+        gObject.dependents = []
+        gObject.subtree = []
+        gObject.waitingOn = 0
+
+    # trashed objects below a trashed folder of the batch go with its topmost one
+    trashedFolders = set(id for id, o in batch.items() if _is_folder(o) and _is_trashed(o))
+    members = set()
+    for id, gObject in batch.items():
+        if not _is_trashed(gObject):
+            continue
+        top = None
+        for ancestor in _ancestors(id, batch):
+            if ancestor in trashedFolders:
+                top = ancestor
+        if top is not None:
+            batch[top].subtree.append(gObject)
+            members.add(id)
+
+    changes = [o for id, o in batch.items() if id not in members]
+    for gObject in changes:
+        # wait for the nearest folder above that's created, renamed or moved in this batch
+        for ancestor in _ancestors(gObject.id, batch):
+            dependency = batch.get(ancestor)
+            if dependency is not None and ancestor not in members and not _is_trashed(dependency):
+                _wait_for(gObject, dependency)
+                break
+
+    # a trashed folder waits for what moves out of it, so it isn't removed from disk first
+    for folder in changes:
+        if not (_is_folder(folder) and _is_trashed(folder)):
+            continue
+        folderPath = _current_path(folder.id)
+        if folderPath is None:
+            continue
+        for gObject in changes:
+            path = _current_path(gObject.id)
+            if not _is_trashed(gObject) and path is not None and path.startswith(folderPath + os.sep):
+                _wait_for(folder, gObject)
+
+    ready = [o for o in changes if o.waitingOn == 0]
+    ready.sort(key=lambda o: (not _is_trashed(o), not _is_folder(o)))
+    if len(members) > 0 or len(ready) < len(changes):
+        logging.debug("planned %d changes: %d ready, %d waiting, %d folded into trashed folders." % \
+                        (len(batch), len(ready), len(changes) - len(ready), len(members)))
+    return ready
+
+
+# plan a batch of changed objects and queue the ones that can run now
+def queue_changes(gObjects: List):
+    for gObject in plan_changes(gObjects):
+        cfg.REMOTE_QUEUE.put(gObject)
+
+
+# called by a remote worker once a change is applied, or given up on. settles the objects
+# folded into it and queues the changes that were waiting for it
+def finish_change(change, db, applied:bool):
+    members = getattr(change, 'subtree', [])
+    change.subtree = []
+    for gObject in members:
+        if applied:
+            _finish_subtree_member(gObject, db)
+        else:
+            cfg.REMOTE_QUEUE.put(gObject)
+
+    released = []
+    with _lock:
+        for gObject in getattr(change, 'dependents', []):
+            gObject.waitingOn -= 1
+            if gObject.waitingOn <= 0:
+                released.append(gObject)
+        change.dependents = []
+    for gObject in released:
+        cfg.REMOTE_QUEUE.put(gObject)
+
+
+# the trashed folder above this object was removed from disk, so only the db is left to
+# update. anything still on disk is handled as a change of its own
+def _finish_subtree_member(gObject, db):
+    dbObjects = db.fetch_gObject(gObject.id)
+    if len(dbObjects) > 0:
+        dbObject = dbObjects[0]
+        if dbObject.localPath and os.path.exists(dbObject.localPath):
+            cfg.REMOTE_QUEUE.put(gObject)
+            return
+        if int(gObject.properties.get('version', 0)) > int(dbObject.properties.get('version', 0)):
+            dbObject.properties = gObject.properties
+            if _is_folder(dbObject):
+                db.update_gObject(folder=dbObject)
+            else:
+                db.update_gObject(file=dbObject)
+    if getattr(gObject, 'journalId', None) is not None:
+        db.delete_journal_entries(gObject.id, gObject.journalId)
@@ -0,0 +1,102 @@
+# client-side quota governor for Drive API calls
+# one token bucket per kind of call, shared by every thread in the process, so the remote
+# workers, the watcher workers and the polling loop together stay under the per-user rate
+# instead of each finding the limit through userRateLimitExceeded.
+# https://developers.google.com/drive/api/guides/limits
+
+import logging
+import os
+import sys
+import threading
+import time
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from config import config as cfg
+
+
+# a permit per call, refilled at rate per second up to burst. callers that find the bucket
+# short reserve their permits anyway and sleep until the refill catches up, so waiters are
+# served in the order they arrived
+class TokenBucket:
+
+    def __init__(self, name:str, rate:float, burst:float):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.granted = 0
+        self.waits = 0
+        self.waitSeconds = 0.0
+
+    # take permits, blocking as long as needed. returns the seconds waited
+    def acquire(self, permits:int = 1) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= permits
+            self.granted += permits
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+                self.waits += 1
+                self.waitSeconds += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "granted": self.granted,
+                "waits": self.waits,
+                "wait_seconds": round(self.waitSeconds, 3),
+                "available": max(0.0, round(self.tokens, 1))
+            }
+
+
+_lock = threading.Lock()
+_buckets = None
+
+def _get_buckets() -> dict:
+    global _buckets
+    with _lock:
+        if _buckets is None:
+            _buckets = {
+                "metadata": TokenBucket("metadata", cfg.QUOTA_METADATA_RATE, cfg.QUOTA_METADATA_BURST),
+                "media": TokenBucket("media", cfg.QUOTA_MEDIA_RATE, cfg.QUOTA_MEDIA_BURST)
+            }
+        return _buckets
+
+# media for content transfers, metadata for everything else
+def call_kind(uri:str) -> str:
+    if 'alt=media' in uri or '/upload/' in uri or '/export' in uri:
+        return "media"
+    return "metadata"
+
+# number of calls a request counts as against the quota. a batch is one per part
+def call_permits(uri:str, body) -> int:
+    if '/batch' in uri and body is not None:
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        return max(1, body.count('Content-ID:'))
+    return 1
+
+# wait for permission to send a request. returns the seconds waited
+def acquire(uri:str, body = None) -> float:
+    if not cfg.QUOTA_GOVERNOR:
+        return 0.0
+    kind = call_kind(uri)
+    wait = _get_buckets()[kind].acquire(call_permits(uri, body))
+    if wait > 1:
+        logging.debug("quota governor held a %s call for %.2f seconds." % (kind, wait))
+    return wait
+
+# live counters per bucket
+def stats() -> dict:
+    return {name: bucket.stats() for name, bucket in _get_buckets().items()}
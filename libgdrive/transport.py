@@ -0,0 +1,241 @@
+# transport layer for Drive API calls
+# httplib2 keeps connections alive per Http object, but Http objects aren't thread safe.
+# every thread gets one authorized keep-alive Http that it reuses for all of its requests,
+# instead of a new TCP and TLS handshake for each call. every request also waits for a permit
+# from the quota governor before it goes out.
+# httplib2 has a single socket timeout per Http, so a thread keeps one Http per class of
+# request (metadata, media, upload), each with its own connect and read timeouts. metadata
+# reads that run past the tail latency can be hedged with a second attempt, as long as the
+# number of hedges in flight stays under its limit.
+
+import collections
+import concurrent.futures
+import contextvars
+import copy
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import google_auth_httplib2
+import googleapiclient.http
+import httplib2
+
+# application imports
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+from libgdrive import quota
+from config import config as cfg
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "congestion": 0,
+            "timeouts": 0, "hedges": 0, "hedge_wins": 0, "hedges_skipped": 0}
+_listeners = []
+_latencies = collections.deque(maxlen=cfg.HEDGE_SAMPLE_WINDOW)
+_executors = {}
+_readSlots = threading.BoundedSemaphore(cfg.HEDGE_WORKERS)
+_hedgeSlots = threading.BoundedSemaphore(cfg.HEDGE_MAX_OUTSTANDING)
+
+
+# call fn(reason) whenever a request is throttled, fails on the server side or times out.
+# fn runs on the thread that made the request, or for a hedged read in a copy of the context
+# of the thread that asked for it
+def add_congestion_listener(fn):
+    with _lock:
+        _listeners.append(fn)
+
+def _congestion(reason:str):
+    with _lock:
+        _stats['congestion'] += 1
+        listeners = list(_listeners)
+    for fn in listeners:
+        try:
+            fn(reason)
+        except Exception as err:
+            logging.error("congestion listener failed. %s" % str(err))
+
+
+# the class of request a uri belongs to, which picks its timeouts
+def request_kind(uri:str, resumable = None) -> str:
+    if resumable is not None or '/upload/' in uri:
+        return "upload"
+    if quota.call_kind(uri) == "media":
+        return "media"
+    return "metadata"
+
+
+# opens its socket and does the TLS handshake under the connect timeout of its class of
+# request, then waits for data under the read timeout
+class _TimedConnectionMixin:
+    connectTimeout = None
+
+    def connect(self):
+        readTimeout = self.timeout
+        self.timeout = self.connectTimeout
+        try:
+            super().connect()
+        finally:
+            self.timeout = readTimeout
+        if self.sock is not None:
+            self.sock.settimeout(readTimeout)
+        with _lock:
+            _stats['connections_opened'] += 1
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, httplib2.HTTPSConnectionWithTimeout):
+    pass
+
+class _TimedHTTPConnection(_TimedConnectionMixin, httplib2.HTTPConnectionWithTimeout):
+    pass
+
+
+# counts whether each request goes over a fresh or an already open connection, and applies
+# the connect and read timeouts of its class of request. the connections it opens are given
+# both timeouts through their class, so reconnects inside httplib2's retries get them too
+class KeepAliveHttp(httplib2.Http):
+    def __init__(self, kind:str = "metadata"):
+        self.kind = kind
+        self.timeouts = cfg.REQUEST_TIMEOUTS[kind]
+        super().__init__(timeout=self.timeouts['read'])
+        fields = {"connectTimeout": self.timeouts['connect']}
+        self.connectionTypes = {"https": type("HTTPSConnection", (_TimedHTTPSConnection, ), fields),
+                                "http": type("HTTPConnection", (_TimedHTTPConnection, ), fields)}
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS, \
+                    connection_type=None):
+        quota.acquire(uri, body)
+        scheme, authority = httplib2.urlnorm(uri)[:2]
+        if connection_type is None:
+            connection_type = self.connectionTypes.get(scheme)
+        conn = self.connections.get(scheme + ":" + authority)
+        with _lock:
+            _stats['requests'] += 1
+            if conn is not None and conn.sock is not None:
+                _stats['connections_reused'] += 1
+        start = time.monotonic()
+        try:
+            resp, content = super().request(uri, method, body, headers, redirections, connection_type)
+        except socket.timeout:
+            with _lock:
+                _stats['timeouts'] += 1
+            _congestion("timeout")
+            raise
+        if resp.status == 429 or resp.status >= 500:
+            _congestion("http %d" % resp.status)
+        elif resp.status == 403 and isinstance(content, bytes) and \
+                any(reason.encode() in content for reason in cfg.RETRY_RATE_LIMIT_REASONS):
+            _congestion("rate limit")
+        elif self.kind == "metadata" and method == "GET" and resp.status < 400:
+            with _lock:
+                _latencies.append(time.monotonic() - start)
+        return resp, content
+
+
+# the authorized keep-alive Http of the calling thread for a class of request
+def get_http(kind:str = "metadata"):
+    if getattr(_local, 'credentials', None) is not cfg.CREDENTIALS:
+        _local.https = {}
+        _local.credentials = cfg.CREDENTIALS
+    http = _local.https.get(kind)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(cfg.CREDENTIALS, http=KeepAliveHttp(kind))
+        _local.https[kind] = http
+        logging.debug("opened keep-alive %s transport for thread %s." % (kind, threading.current_thread().name))
+    return http
+
+
+# a Drive API request that goes out over the calling thread's Http for its class of request,
+# and hedges metadata reads when HEDGE_METADATA_READS is set. built by the service objects
+# through gDrive.build_request
+class DriveRequest(googleapiclient.http.HttpRequest):
+    def __init__(self, http, postproc, uri, method="GET", body=None, headers=None, methodId=None, resumable=None):
+        self.kind = request_kind(uri, resumable)
+        super().__init__(get_http(self.kind), postproc, uri, method=method, body=body, headers=headers, \
+                            methodId=methodId, resumable=resumable)
+
+    def execute(self, http=None, num_retries=0):
+        delay = None
+        if http is None and self.kind == "metadata" and self.method == "GET":
+            delay = _hedge_delay()
+        # a read that finds every hedging slot taken runs on its own thread, unhedged
+        if delay is None or not _readSlots.acquire(blocking=False):
+            return super().execute(http=http, num_retries=num_retries)
+        return _execute_hedged(self, delay, num_retries)
+
+
+# seconds to wait before hedging a metadata read, None if hedging is off or there aren't
+# enough samples yet
+def _hedge_delay() -> float:
+    if not cfg.HEDGE_METADATA_READS:
+        return None
+    with _lock:
+        if len(_latencies) < cfg.HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(_latencies)
+    index = min(len(samples) - 1, int(len(samples) * cfg.HEDGE_PERCENTILE))
+    return max(cfg.HEDGE_MIN_DELAY, samples[index])
+
+
+# first attempts of hedged reads and the hedges run on separate executors, each sized to the
+# slots that admit work to it, so nothing ever waits in an executor's queue
+def _executor(kind:str) -> concurrent.futures.ThreadPoolExecutor:
+    with _lock:
+        if kind not in _executors:
+            workers = cfg.HEDGE_WORKERS if kind == "read" else cfg.HEDGE_MAX_OUTSTANDING
+            _executors[kind] = concurrent.futures.ThreadPoolExecutor(max_workers=workers, \
+                                    thread_name_prefix="hedge-" + kind)
+        return _executors[kind]
+
+
+# one attempt of a request over the Http of the executing thread. the slot that admitted it
+# is held until the attempt is over, even if the other attempt answered first
+def _attempt(request, numRetries:int, slots):
+    try:
+        return googleapiclient.http.HttpRequest.execute(request, http=get_http(request.kind), num_retries=numRetries)
+    finally:
+        slots.release()
+
+
+# send the request, and a copy of it if no answer came within delay and a hedge slot is free.
+# returns the first successful answer, or raises the error of the first attempt if both failed.
+# the caller has taken a read slot
+def _execute_hedged(request, delay:float, numRetries:int):
+    first = _executor("read").submit(contextvars.copy_context().run, _attempt, request, numRetries, _readSlots)
+    try:
+        return first.result(timeout=delay)
+    except concurrent.futures.TimeoutError:
+        pass
+
+    if not _hedgeSlots.acquire(blocking=False):
+        with _lock:
+            _stats['hedges_skipped'] += 1
+        return first.result()
+    hedge = copy.copy(request)
+    hedge.headers = dict(request.headers)
+    second = _executor("hedge").submit(contextvars.copy_context().run, _attempt, hedge, numRetries, _hedgeSlots)
+    with _lock:
+        _stats['hedges'] += 1
+    for attempt in concurrent.futures.as_completed([first, second]):
+        if attempt.exception() is None:
+            if attempt is second:
+                with _lock:
+                    _stats['hedge_wins'] += 1
+            return attempt.result()
+    return first.result()
+
+
+# request and connection reuse counters across all threads
+def stats() -> dict:
+    with _lock:
+        s = dict(_stats)
+    if s['requests'] > 0:
+        s['reuse_ratio'] = s['connections_reused'] / s['requests']
+    else:
+        s['reuse_ratio'] = 0.0
+    delay = _hedge_delay()
+    if delay is not None:
+        s['hedge_delay'] = delay
+    return s